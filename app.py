@@ -1,9 +1,18 @@
+import time
+
+RUN_STARTED = time.perf_counter()  # for the render timing caption at the bottom
+
 import streamlit as st
-import requests
-import pandas as pd
-import psycopg2
-import os
+from dataclasses import replace
 from datetime import date, datetime, timedelta
+from ehr_sync import REUSE_MAX_AGE_HOURS, IncrementalSync
+from ehr_store import save_records
+from ehr_records import AppointmentBatch, AppointmentRecord, InsurancePolicy, parse_date, parse_start_time
+from ehr_http import EhrClient, open_client, practice_session_loader
+from ehr_ui import fetch_job, paged_table, render_timing, results_table, sync_options
+
+IMPORTS_DONE = time.perf_counter()
+
 # from dotenv import load_dotenv
 
 # load_dotenv()  # Load environment variables from .env file
@@ -14,8 +23,47 @@ from datetime import date, datetime, timedelta
 
 # ---------- CONFIG ----------
 BASE_URL = "https://static.practicefusion.com"
+PLATFORM = "practicefusion"
+MAX_WORKERS = 8  # concurrent per-patient enrichment calls
+RATE_LIMIT = 20  # requests per second, per practice
+START_TIME_EPOCH_UNIT = "s"  # startAtDateTimeFlt is epoch seconds of the practice's wall-clock time
+MAX_DETAIL_ROWS = 20  # selected rows that get their skipped stages loaded on demand
+RESULT_COLUMNS = [  # AppointmentBatch columns shown in the results table, in order
+    "appointment_id", "patient_key", "patient_name", "provider", "dob", "phone", "appointment_type",
+    "start_time", "status", "primary_plan", "primary_member_id", "secondary_plan", "secondary_member_id",
+    "transcripts", "patient_notes", "insurance_raw",
+]
+
+# Enriched rows are upserted into ehr_schema.<DB_TABLE>
+DB_TABLE = "practicefusion_appointments"
+DB_COLUMNS = [
+    # Fleet runs share the table, so rows are keyed per practice (see DB_KEY)
+    ("practice", "TEXT NOT NULL DEFAULT 'default'", lambda record: record.practice or "default"),
+    ("appointment_id", "TEXT", lambda record: record.appointment_id),
+    ("patient_uid", "TEXT", lambda record: record.patient_key),
+    ("name", "TEXT", lambda record: record.patient_name),
+    ("provider", "TEXT", lambda record: record.provider),
+    ("dob", "TEXT", lambda record: record.dob),
+    ("phone", "TEXT", lambda record: record.phone),
+    ("appointment_type", "TEXT", lambda record: record.appointment_type),
+    ("start_time", "TEXT", lambda record: record.start_time),
+    ("appointment_date", "DATE", lambda record: record.appointment_date),
+    ("status", "TEXT", lambda record: record.status),
+    ("primary_insurance", "TEXT", lambda record: record.primary.plan if record.primary else None),
+    ("primary_insurance_id", "TEXT", lambda record: record.primary.member_id if record.primary else None),
+    ("secondary_insurance", "TEXT", lambda record: record.secondary.summary() if record.secondary else None),
+    ("transcripts", "TEXT", lambda record: record.transcripts),
+    ("patient_notes", "TEXT", lambda record: record.patient_notes),
+    ("insurance", "JSONB", lambda record: record.insurance_raw),
+]
+# Filled by optional enrichment stages; a run that skipped a stage leaves the stored value alone
+DB_STAGE_COLUMNS = ["primary_insurance", "primary_insurance_id", "secondary_insurance", "transcripts", "patient_notes", "insurance"]
+DB_KEY = ["practice", "appointment_id"]
+DB_INDEXES = ["appointment_date", "provider", "patient_uid"]
 
 def get_db_connection():
+    import psycopg2
+
     return psycopg2.connect(
        host = "aws-1-us-east-1.pooler.supabase.com",
     dbname = "postgres",
@@ -24,22 +72,249 @@ def get_db_connection():
     port = "5432"
        
     )
-# 🔹 Fetch latest session from DB
-def get_latest_session():
+# Sessions without a practice_id in extra_info belong to the "default" practice
+PRACTICE_SQL = "COALESCE(extra_info->>'practice_id', 'default')"
+
+# 🔹 Fetch latest session from DB, optionally for one practice; returns (practice, (cookie, csrf_token))
+def get_latest_session(practice=None):
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute("""
-        SELECT extra_info->>'cookie', extra_info->>'csrf_token' 
+    cur.execute(f"""
+        SELECT {PRACTICE_SQL}, extra_info->>'cookie', extra_info->>'csrf_token'
         FROM ehr_schema.sessions_table
         WHERE expiry > NOW()
         AND platform = 'practicefusion'
+        AND (%(practice)s IS NULL OR {PRACTICE_SQL} = %(practice)s)
         ORDER BY expiry DESC
         LIMIT 1;
-    """)
+    """, {"practice": practice})
     row = cur.fetchone()
     cur.close()
     conn.close()
-    return row if row else None
+    return (row[0], row[1:]) if row else None
+
+
+# Newest valid session for every practice, for fleet runs
+def list_practice_sessions():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT DISTINCT ON ({PRACTICE_SQL}) {PRACTICE_SQL}, extra_info->>'cookie', extra_info->>'csrf_token'
+        FROM ehr_schema.sessions_table
+        WHERE expiry > NOW()
+        AND platform = 'practicefusion'
+        ORDER BY {PRACTICE_SQL}, expiry DESC;
+    """)
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return {practice: (cookie, csrf_token) for practice, cookie, csrf_token in rows}
+
+
+def build_headers(cookie_string, csrf_token):
+    return {
+        "accept": "application/json",
+        "content-type": "application/json; charset=UTF-8",
+        "cookie": cookie_string,
+        "authorization": csrf_token,
+    }
+
+
+# Schedule report rows carry an event id; fall back to patient + start time
+def appointment_key(p):
+    appt_id = p.get("eventId") or p.get("appointmentId")
+    if appt_id:
+        return str(appt_id)
+    return f"{p.get('patientPracticeGuid')}@{p.get('startAtDateTimeFlt')}"
+
+
+def patient_key(p):
+    return p.get("patientPracticeGuid")
+
+
+# Step 1: Fetch the schedule report page by page
+def fetch_schedule(client, start_date, end_date, log):
+    # Convert dates to ET timezone format
+    # Start date: beginning of day in ET (00:00:00 ET = 04:00:00 UTC)
+    start_datetime = f"{start_date}T04:00:00.000Z"
+
+    # End date: end of day in ET (23:59:59 ET = 03:59:59 UTC next day)
+    end_date_obj = datetime.combine(end_date, datetime.min.time())
+    next_day = end_date_obj + timedelta(days=1)
+    end_datetime = f"{next_day.strftime('%Y-%m-%d')}T03:59:59.000Z"
+
+    payload = {
+        "startMinimumDateTimeUtc": start_datetime,
+        "startMaximumDateTimeUtc": end_datetime
+    }
+
+    all_patients = []
+    page = 0
+    page_size = 50
+
+    while True:
+        resp = client.post(
+            f"{BASE_URL}/ScheduleEndpoint/api/v1/Schedule/Report/{page}/{page_size}",
+            json=payload
+        )
+
+        if resp.status_code != 200:
+            log(f"Failed to fetch patients on page {page}: {resp.text}", "error")
+            break
+
+        patients = resp.json().get("scheduledEventList", [])
+        if not patients:  # no more data
+            break
+
+        all_patients.extend(patients)
+        page += 1  # move to next page
+
+    return all_patients
+
+
+# Step 2: Insurance details
+def fetch_insurance(client, patient_uid):
+    ins_resp = client.get(
+        f"https://static.practicefusion.com/PatientEndpoint/api/v1/patients/{patient_uid}/patientRibbonInfo",
+    )
+    insurance = ins_resp.json() if ins_resp.status_code == 200 else {}
+
+    # Extract insurance information
+    primary = InsurancePolicy("N/A", "N/A")
+    secondary = InsurancePolicy("N/A", "N/A")
+
+    if insurance:
+        # Primary insurance
+        primary_plan = insurance.get("primaryInsurancePlan", {})
+        if primary_plan:
+            primary = InsurancePolicy(primary_plan.get("payerName", "N/A"), primary_plan.get("policyIdentifier", "N/A"))
+        
+        # Secondary insurance (if available in the API response)
+        secondary_plan = insurance.get("secondaryInsurancePlan", {})
+        if secondary_plan:
+            secondary = InsurancePolicy(secondary_plan.get("payerName", "N/A"), secondary_plan.get("policyIdentifier", "N/A"))
+
+    return {"primary": primary, "secondary": secondary, "insurance_raw": insurance}
+
+
+# Step 3: Visit details
+def fetch_transcripts(client, patient_uid):
+    transcript_resp = client.get(
+        f"https://static.practicefusion.com/ChartingEndpoint/api/v4/patients/{patient_uid}/transcriptSummaries",
+    )
+    transcripts = transcript_resp.json().get("transcriptDisplaySummaries", []) if transcript_resp.status_code == 200 else []
+
+    # Store all transcripts as JSON
+    all_transcripts = []
+    for t in transcripts:
+        transcript_date = t.get("dateOfServiceLocal", "N/A")
+        transcript_type = t.get("encounterTypeEncounterEventTypeName", "N/A")
+        all_transcripts.append(f"{transcript_date} - {transcript_type}")
+
+    # Join them as one string (or keep as list if you prefer)
+    transcripts_str = "; ".join(all_transcripts) if all_transcripts else "N/A"
+    return {"transcripts": transcripts_str}
+
+
+# Step 3.5: Fetch patient notes
+def fetch_patient_notes(client, patient_uid):
+    patient_details_resp = client.get(
+        f"https://static.practicefusion.com/PatientEndpoint/api/v3/patients/{patient_uid}",
+    )
+    patient_notes = "N/A"
+    if patient_details_resp.status_code == 200:
+        patient_data = patient_details_resp.json()
+        patient_notes = patient_data.get("patient", {}).get("notes", "N/A")
+    return {"patient_notes": patient_notes}
+
+
+# Per-patient enrichment stages: one API call each, filling the listed record fields.
+# Stages left off during a fetch leave their fields as None and are loaded on demand.
+ENRICHMENT_STAGES = {
+    "insurance": {
+        "label": "Insurance (ribbon)",
+        "fetch": fetch_insurance,
+        "fields": ["primary", "secondary", "insurance_raw"],
+    },
+    "transcripts": {
+        "label": "Visit transcripts",
+        "fetch": fetch_transcripts,
+        "fields": ["transcripts"],
+    },
+    "notes": {
+        "label": "Patient notes",
+        "fetch": fetch_patient_notes,
+        "fields": ["patient_notes"],
+    },
+}
+
+
+# Run the selected stages for one patient
+def fetch_patient_details(client, patient_uid, stages):
+    details = {}
+    for stage in stages:
+        details.update(ENRICHMENT_STAGES[stage]["fetch"](client, patient_uid))
+    return details
+
+
+# Stages whose fields were never loaded for this record
+def missing_stages(record):
+    return [
+        stage for stage, spec in ENRICHMENT_STAGES.items()
+        if any(getattr(record, field) is None for field in spec["fields"])
+    ]
+
+
+# Create one record per appointment with the patient's details
+def build_record(p, details, practice=None):
+    return AppointmentRecord(
+        platform=PLATFORM,
+        appointment_id=appointment_key(p),
+        patient_key=p.get("patientPracticeGuid"),
+        patient_name=p.get("patientName"),
+        provider=p.get("providerName"),
+        dob=parse_date(p.get("patientDateOfBirthDateTime")),
+        phone=p.get("patientMobilePhone"),
+        appointment_type=p.get("appointmentTypeName"),
+        start_time=parse_start_time(p.get("startAtDateTimeFlt"), START_TIME_EPOCH_UNIT),
+        status=p.get("status"),
+        practice=practice,
+        **details,
+    )
+
+
+# Full fetch and enrichment for one date range; runs on a background job thread, so no st.* calls here
+# `practice`/`session` are set by fleet runs; otherwise the newest session, and its practice, are used
+def run_sync(job, start_date, end_date, stages, incremental, save_to_db, practice=None, session=None):
+    practice, client = open_client(
+        job, get_latest_session, build_headers, practice, session, pool_size=MAX_WORKERS, rate_limit=RATE_LIMIT
+    )
+    all_patients = fetch_schedule(client, start_date, end_date, job.log)
+
+    if not all_patients:
+        raise RuntimeError("No patients found.")
+
+    job.log(f"✅ Fetched {len(all_patients)} patients")
+    job.set_total(len(all_patients))
+
+    # Each practice keeps its own snapshot
+    sync = IncrementalSync(job, f"{PLATFORM}.{practice}", all_patients, appointment_key, patient_key, incremental, practice, stages)
+    sync.enrich(
+        job,
+        lambda patient_uid: fetch_patient_details(client, patient_uid, stages),
+        lambda p, details: build_record(p, details, practice),
+        MAX_WORKERS,
+    )
+    job.log(f"✅ Enriched {len(sync.pending)} new or changed patients")
+    data = sync.finish()
+
+    # Step 5: Persist to Postgres
+    if save_to_db:
+        save_records(
+            job, get_db_connection, DB_TABLE, DB_COLUMNS, DB_KEY, data, DB_INDEXES, keep_existing=DB_STAGE_COLUMNS
+        )
+
+    return AppointmentBatch.from_records(data)
 
 
 # ---------- STREAMLIT UI ----------
@@ -52,168 +327,65 @@ start_date, end_date = st.date_input(
     [date(2025, 7, 31), date(2025, 8, 20)]  # default
 )
 
-if st.button("Fetch Patients"):
-    st.write("Fetching data...",os.getenv("host"))
-    with st.status("Fetching data...", expanded=True) as status:
-        session = get_latest_session()
-        if not session:
-            st.error("⚠️ No valid session found in DB")
-        else:
-            cookie_string, csrf_token = session
-            st.write("✅ Got session from DB")
-
-            # Example API call
-            HEADERS = {
-                "accept": "application/json",
-                "content-type": "application/json; charset=UTF-8",
-                "cookie": cookie_string,
-                "authorization": csrf_token,
-                
-            }
-            # Step 1: Fetch patients
-            # Convert dates to ET timezone format
-            # Start date: beginning of day in ET (00:00:00 ET = 04:00:00 UTC)
-            start_datetime = f"{start_date}T04:00:00.000Z"
-            
-            # End date: end of day in ET (23:59:59 ET = 03:59:59 UTC next day)
-            end_date_obj = datetime.combine(end_date, datetime.min.time())
-            next_day = end_date_obj + timedelta(days=1)
-            end_datetime = f"{next_day.strftime('%Y-%m-%d')}T03:59:59.000Z"
-            
-            payload = {
-                "startMinimumDateTimeUtc": start_datetime,
-                "startMaximumDateTimeUtc": end_datetime
-            }
-
-           
-            all_patients = []
-            page = 0
-            page_size = 50
-
-            while True:
-                resp = requests.post(
-                    f"{BASE_URL}/ScheduleEndpoint/api/v1/Schedule/Report/{page}/{page_size}",
-                    headers=HEADERS,
-                    json=payload
-                )
-
-                if resp.status_code != 200:
-                    st.error(f"Failed to fetch patients on page {page}: {resp.text}")
-                    break
-
-                patients = resp.json().get("scheduledEventList", [])
-                if not patients:  # no more data
-                    break
-
-                all_patients.extend(patients)
-                page += 1  # move to next page
-
-            if resp.status_code != 200:
-                st.error(f"Failed to fetch patients: {resp.text}")
-            if not all_patients:
-                st.error("No patients found.")
-            else:
-
-                st.write(f"✅ Fetched {len(all_patients)} patients")
-
-                data = []
-                for p in all_patients:
-                    patient_uid = p.get("patientPracticeGuid")
-                    name = p.get("patientName")
-                    provider=p.get("providerName")
-                    # Extract DOB as date only
-                    Dob = p.get("patientDateOfBirthDateTime")
-                    if Dob:
-                        # Parse the datetime and extract just the date part
-                        try:
-                            dob_datetime = datetime.fromisoformat(Dob.replace('Z', '+00:00'))
-                            Dob = dob_datetime.strftime('%Y-%m-%d')  # Format as YYYY-MM-DD
-                        except:
-                            Dob = "N/A"  # If parsing fails, keep as N/A
-                    else:
-                        Dob = "N/A"
-                    Phone = p.get("patientMobilePhone")
-                    AppointmentType = p.get("appointmentTypeName")
-                    StartTime = p.get("startAtDateTimeFlt")
-                    Status = p.get("status")
-
-                    # Step 2: Insurance details
-                    ins_resp = requests.get(
-                        f"https://static.practicefusion.com/PatientEndpoint/api/v1/patients/{patient_uid}/patientRibbonInfo",
-                        headers=HEADERS,
-                    )
-                    insurance = ins_resp.json() if ins_resp.status_code == 200 else {}
-
-                    # Extract insurance information
-                    primary_insurance = "N/A"
-                    primary_insurance_id = "N/A"
-                    # secondary_insurance = "N/A"
-                    # secondary_insurance_id = "N/A"
-                    secondary_insurance_combined = "N/A"
-
-
-                    if insurance:
-                        # Primary insurance
-                        primary_plan = insurance.get("primaryInsurancePlan", {})
-                        if primary_plan:
-                            primary_insurance = primary_plan.get("payerName", "N/A")
-                            primary_insurance_id = primary_plan.get("policyIdentifier", "N/A")
-                        
-                        # Secondary insurance (if available in the API response)
-                        secondary_plan = insurance.get("secondaryInsurancePlan", {})
-                        if secondary_plan:
-                            sec_payer = secondary_plan.get("payerName", "N/A")
-                            sec_id = secondary_plan.get("policyIdentifier", "N/A")
-                            secondary_insurance_combined = f"{sec_payer} - {sec_id}" if sec_payer != "N/A" and sec_id != "N/A" else "N/A"
-
-                    # Step 3: Visit details
-                    transcript_resp = requests.get(
-                        f"https://static.practicefusion.com/ChartingEndpoint/api/v4/patients/{patient_uid}/transcriptSummaries",
-                        headers=HEADERS,
-                    )
-                    transcripts = transcript_resp.json().get("transcriptDisplaySummaries", []) if transcript_resp.status_code == 200 else []
-
-                    # Store all transcripts as JSON
-                    all_transcripts = []
-                    for t in transcripts:
-                        transcript_date = t.get("dateOfServiceLocal", "N/A")
-                        transcript_type = t.get("encounterTypeEncounterEventTypeName", "N/A")
-                        all_transcripts.append(f"{transcript_date} - {transcript_type}")
-
-                    # Join them as one string (or keep as list if you prefer)
-                    transcripts_str = "; ".join(all_transcripts) if all_transcripts else "N/A"
-                    
-                    # Step 3.5: Fetch patient notes
-                    patient_details_resp = requests.get(
-                        f"https://static.practicefusion.com/PatientEndpoint/api/v3/patients/{patient_uid}",
-                        headers=HEADERS,
+stages = st.multiselect(
+    "Enrichment stages",
+    options=list(ENRICHMENT_STAGES),
+    default=list(ENRICHMENT_STAGES),
+    format_func=lambda stage: ENRICHMENT_STAGES[stage]["label"],
+    help="Each stage costs one call per patient. Stages left off are loaded only for the rows you select in the results table."
+)
+
+incremental, progressive, save_to_db, fleet = sync_options(DB_TABLE)
+
+# Lazily load skipped stages for the rows the user selected, once per practice, patient and stage;
+# loaded details expire like reused snapshot rows do
+def show_row_details(records):
+    if not records:
+        return
+    if len(records) > MAX_DETAIL_ROWS:
+        st.caption(f"Showing details for the first {MAX_DETAIL_ROWS} selected rows")
+        records = records[:MAX_DETAIL_ROWS]
+
+    cutoff = time.time() - REUSE_MAX_AGE_HOURS * 3600
+    loaded = {
+        key: (fetched_at, stage_details)
+        for key, (fetched_at, stage_details) in st.session_state.get("lazy_details", {}).items()
+        if fetched_at >= cutoff
+    }
+    st.session_state["lazy_details"] = loaded
+    clients = {}
+    for record in records:
+        patient_uid = record.patient_key
+        practice = record.practice
+        details = {}
+        for stage in missing_stages(record):
+            key = (practice, patient_uid, stage)
+            if key not in loaded:
+                if practice not in clients:
+                    latest = get_latest_session(practice)
+                    if not latest:
+                        st.error("⚠️ No valid session found in DB")
+                        return
+                    clients[practice] = EhrClient(
+                        latest[1], practice_session_loader(get_latest_session, practice), build_headers
                     )
-                    patient_notes = "N/A"
-                    if patient_details_resp.status_code == 200:
-                        patient_data = patient_details_resp.json()
-                        patient_notes = patient_data.get("patient", {}).get("notes", "N/A")
-
-                    # Create one row per patient with all transcripts
-                    data.append({
-                        "Patient UID": patient_uid,
-                        "Name": name,
-                        "Provider": provider,
-                        "DOB": Dob,
-                        "Phone": Phone,
-                        "Appointment Type": AppointmentType,
-                        "Start Time": StartTime,
-                        "Status": Status,
-                        "Primary Insurance": primary_insurance,
-                        "Primary Insurance ID": primary_insurance_id,
-                        "Secondary Insurance + Member ID": secondary_insurance_combined,
-                        "All Transcripts": transcripts_str,
-                        "Patient Notes": patient_notes,
-                        "Insurance": insurance
-                    })
-
-                # Step 4: Show in table
-                df = pd.DataFrame(data)
-                st.dataframe(df)
-
-                status.update(label="✅ All data fetched successfully!", state="complete")
+                loaded[key] = (time.time(), ENRICHMENT_STAGES[stage]["fetch"](clients[practice], patient_uid))
+            details.update(loaded[key][1])
+
+        with st.expander(f"{record.patient_name} - {record.appointment_type} ({record.start_time})", expanded=True):
+            record = replace(record, **details)
+            st.json({key: value for key, value in record.to_json().items() if value is not None}, expanded=False)
+
+
+# Fetches run in the background; identical requests share one job, and its results are cached for a while
+job = fetch_job(
+    PLATFORM, "Fetch Patients", (str(start_date), str(end_date), tuple(sorted(stages)), incremental, save_to_db),
+    run_sync, (start_date, end_date, stages, incremental, save_to_db),
+    get_latest_session, list_practice_sessions, fleet, progressive, RESULT_COLUMNS,
+)
+if job:
+    # Step 4: Show in table; selecting rows loads any stages that were skipped
+    selected = paged_table(results_table(job.id, job.result, RESULT_COLUMNS), "results", selectable=True)
+    show_row_details([job.result.record(i) for i in selected])
 
+render_timing("app", RUN_STARTED, IMPORTS_DONE)
@@ -0,0 +1,128 @@
+import math
+
+import pandas as pd
+
+# ---------- CONFIG ----------
+# Columns sent to the model, most relevant first; includes the dashboards' export columns.
+# Anything else in the sheet is left out, so a wider sheet never makes the prompt bigger
+CONTEXT_COLUMNS = [
+    "Appointment date",
+    "Start Time",
+    "Patient Name",
+    "DOB",
+    "Primary Insurance",
+    "Member ID#",
+    "Primary Insurance ID",
+    "Primary Member ID",
+    "Plan Type",
+    "Copay/Copay Telehealth/Coinsurance",
+    "Remaining Deductibles & OOP Maximum",
+    "No of Visits",
+    "Auth",
+    "Authorization",
+    "Secondary Insurance Info",
+    "Secondary Insurance + Member ID",
+    "Secondary Insurance",
+    "Secondary Policy Number",
+    "Secondary Member ID",
+    "Notes",
+    "Remarks",
+    "Alert Message",
+    "Patient Notes",
+    "All Transcripts",
+]
+# Never sent and not reported as left out: earlier notes, raw API payloads and the dashboards' internal IDs
+EXCLUDED_COLUMNS = ["EHR Note", "Generated EHR Note", "Insurance", "Appointment ID", "Patient GUID"]
+CONTEXT_TOKEN_BUDGET = 1200  # per row, for the patient data part of the prompt
+MAX_FIELD_TOKENS = 150  # longer values are truncated
+MIN_FIELD_TOKENS = 10  # a field that can't get this much of the budget is dropped instead
+CHARS_PER_TOKEN = 4  # rough local estimate, good enough for budgeting
+TRUNCATION_MARKER = " …[truncated]"
+
+
+def has_value(value):
+    return pd.notna(value) and str(value).strip() != ""
+
+
+def normalize_column(name):
+    return " ".join(str(name).lower().split())
+
+
+CONTEXT_RANK = {normalize_column(column): rank for rank, column in enumerate(CONTEXT_COLUMNS)}
+EXCLUDED = {normalize_column(column) for column in EXCLUDED_COLUMNS}
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def truncate_to_tokens(text, tokens):
+    limit = tokens * CHARS_PER_TOKEN
+    return text if len(text) <= limit else text[:limit].rstrip() + TRUNCATION_MARKER
+
+
+# Split `budget` across fields: short ones get all they need, long ones share the rest equally
+def allocate_tokens(needs, budget):
+    allocation = [0] * len(needs)
+    remaining = budget
+    by_need = sorted(range(len(needs)), key=lambda i: needs[i])
+    for position, i in enumerate(by_need):
+        allocation[i] = min(needs[i], remaining // (len(needs) - position))
+        remaining -= allocation[i]
+    return allocation
+
+
+# Patient data for the prompt: allow-listed columns by relevance, long values truncated, within the token budget
+def build_row_context(row_data, budget=CONTEXT_TOKEN_BUDGET):
+    """Return the context text and a report of its estimated tokens and the columns dropped or truncated.
+
+    Each line's estimate covers its ``key: `` prefix, newline and truncation
+    marker, so the whole text stays within ``budget``. Every allow-listed field
+    is kept, truncated if needed, as long as each can get MIN_FIELD_TOKENS;
+    only then are the lowest-ranked fields dropped.
+    """
+    marker_tokens = estimate_tokens(TRUNCATION_MARKER)
+    ranked = []
+    dropped = []
+    for key, value in row_data.items():
+        if not has_value(value) or normalize_column(key) in EXCLUDED:
+            continue
+        rank = CONTEXT_RANK.get(normalize_column(key))
+        if rank is None:
+            dropped.append(key)
+            continue
+        text = str(value).strip()
+        overhead = estimate_tokens(f"{key}: \n")
+        value_tokens = estimate_tokens(text)
+        need = value_tokens if value_tokens <= MAX_FIELD_TOKENS else MAX_FIELD_TOKENS + marker_tokens
+        ranked.append((rank, key, text, overhead, need, min(need, MIN_FIELD_TOKENS + marker_tokens)))
+    ranked.sort(key=lambda item: item[0])
+
+    while ranked and sum(overhead + least for *_, overhead, _, least in ranked) > budget:
+        dropped.append(ranked.pop()[1])
+
+    # Every field first gets its minimum; what is left is shared out by need
+    spare = budget - sum(overhead + least for *_, overhead, _, least in ranked)
+    extra = allocate_tokens([need - least for *_, need, least in ranked], spare)
+
+    lines = []
+    truncated = []
+    used = 0
+    for (_, key, text, overhead, need, least), bonus in zip(ranked, extra):
+        tokens = least + bonus
+        value = text if tokens >= estimate_tokens(text) else truncate_to_tokens(text, tokens - marker_tokens)
+        line = f"{key}: {value}\n"
+        if used + estimate_tokens(line) > budget:
+            dropped.append(key)
+            continue
+        if value != text:
+            truncated.append(key)
+        lines.append(line)
+        used += estimate_tokens(line)
+
+    return "".join(lines), {"tokens": used, "dropped": dropped, "truncated": truncated}
+
+
+# What the prompt used to carry: every non-null column
+def full_context_tokens(row_data):
+    return sum(estimate_tokens(f"{key}: {value}") for key, value in row_data.items() if pd.notna(value))
@@ -0,0 +1,163 @@
+import threading
+import time
+
+# ---------- CONFIG ----------
+# 403 is left out: it is also what one forbidden resource (e.g. one patient's insurance) returns,
+# so it fails only that request instead of pausing every worker for a session swap
+AUTH_FAILURE_STATUSES = (401,)
+SESSION_WAIT_SECONDS = 60  # how long to wait for a fresh session row to show up
+SESSION_POLL_SECONDS = 5
+MAX_SESSION_SWAPS = 3  # per request, so a broken login can't loop forever
+DEFAULT_POOL_SIZE = 10  # keep-alive connections per host
+REQUEST_TIMEOUT = (10, 60)  # seconds to connect, and to wait between bytes of the response
+
+
+class SessionExpired(Exception):
+    pass
+
+
+# Spaces request starts evenly so one client never exceeds `per_second`
+class RateLimiter:
+    def __init__(self, per_second):
+        self._interval = 1.0 / per_second
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + self._interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+# Expired sessions come back as 401, or as a redirect to the login page
+def is_auth_failure(resp):
+    if resp.status_code in AUTH_FAILURE_STATUSES:
+        return True
+    redirected_to_login = "login" in resp.url.lower()
+    return redirected_to_login and (bool(resp.history) or "text/html" in resp.headers.get("content-type", ""))
+
+
+# HTTP client shared by one run's workers; hot-swaps the session when it expires mid-run
+class EhrClient:
+    """Wraps a ``requests.Session`` whose auth headers can be replaced mid-run.
+
+    ``load_session()`` returns the newest ``(cookie, csrf_token)`` row (or None)
+    and ``build_headers(cookie, csrf_token)`` turns it into request headers.
+    When a response looks like an expired login, new requests are paused, a
+    fresh session is loaded from the DB and only the failed requests are
+    replayed, so a long run doesn't silently turn into "N/A" rows.
+
+    Each client has its own connection pool (``pool_size`` connections per
+    host) and, with ``rate_limit`` set, sends at most that many requests per
+    second, so several practices can be fetched side by side. Requests
+    without their own ``timeout`` use ``REQUEST_TIMEOUT``, so a hung
+    connection fails its request instead of stalling the run.
+    """
+
+    def __init__(self, session, load_session, build_headers, log=None, pool_size=DEFAULT_POOL_SIZE, rate_limit=None):
+        self._load_session = load_session
+        self._build_headers = build_headers
+        # requests is only needed once a fetch starts, so it stays out of the first render
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self._log = log or (lambda text, level="info": None)
+        self._http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._http.mount("https://", adapter)
+        self._http.mount("http://", adapter)
+        self._limiter = RateLimiter(rate_limit) if rate_limit else None
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._ready.set()
+        self._generation = 0
+        self._expired = None
+        self.headers = build_headers(*session)
+        self.swaps = 0
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        for _ in range(MAX_SESSION_SWAPS + 1):
+            # Wait here while another worker is swapping the session
+            self._ready.wait()
+            if self._expired:
+                raise self._expired
+
+            generation = self._generation
+            if self._limiter:
+                self._limiter.wait()
+            resp = self._http.request(method, url, headers=self.headers, **{"timeout": REQUEST_TIMEOUT, **kwargs})
+            if not is_auth_failure(resp):
+                return resp
+            self._refresh(generation)
+
+        raise SessionExpired(f"Still unauthorized after {MAX_SESSION_SWAPS} session swaps: {method} {url}")
+
+    # Swap in a fresh session, unless another worker already did since `generation`
+    def _refresh(self, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            if self._expired:
+                raise self._expired
+
+            self._ready.clear()
+            try:
+                self._log("🔐 Session expired mid-run; waiting for a fresh session...", "warning")
+                deadline = time.monotonic() + SESSION_WAIT_SECONDS
+                while True:
+                    session = self._load_session()
+                    if session and self._build_headers(*session) != self.headers:
+                        break
+                    if time.monotonic() >= deadline:
+                        self._expired = SessionExpired(
+                            "Session expired and no fresh session was found in the DB"
+                        )
+                        raise self._expired
+                    time.sleep(SESSION_POLL_SECONDS)
+
+                self.headers = self._build_headers(*session)
+                self._generation += 1
+                self.swaps += 1
+                self._log("🔄 Switched to a fresh session; replaying failed requests")
+            finally:
+                self._ready.set()
+
+
+# `load_session` for EhrClient: the newest session of one practice
+def practice_session_loader(get_latest_session, practice):
+    def load_session():
+        latest = get_latest_session(practice)
+        return latest[1] if latest else None
+    return load_session
+
+
+# The client for one run, from the session a fleet run handed over or the newest one in the DB
+def open_client(job, get_latest_session, build_headers, practice=None, session=None, **options):
+    """Return ``(practice, client)``; ``options`` go to ``EhrClient``.
+
+    ``get_latest_session(practice)`` returns ``(practice, (cookie, csrf_token))``
+    or None. Without a ``session`` the newest one is used, and the run belongs
+    to that session's practice.
+    """
+    if session is None:
+        latest = get_latest_session(practice)
+        if not latest:
+            raise RuntimeError("⚠️ No valid session found in DB")
+        practice, session = latest
+    job.log("✅ Got session from DB")
+
+    # Shared by all of the run's workers; swaps in a fresh session if this one expires mid-run
+    load_session = practice_session_loader(get_latest_session, practice)
+    return practice, EhrClient(session, load_session, build_headers, job.log, **options)
@@ -0,0 +1,309 @@
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from ehr_records import AppointmentBatch
+
+# ---------- CONFIG ----------
+MAX_CONCURRENT_JOBS = 4
+JOB_RETENTION_SECONDS = 3600  # finished jobs stay pollable for an hour
+JOB_DEADLINE_SECONDS = 1800  # a job still unfinished after this is cancelled when its query is asked for again
+RESULT_CACHE_TTL_SECONDS = 600  # a finished fetch answers identical queries for 10 minutes
+RESULT_CACHE_MAX_BYTES = 256 * 1024 * 1024  # least recently used results are dropped past this
+MAX_CONCURRENT_PRACTICES = 4  # practices fetched side by side in a fleet run
+
+
+class JobCancelled(Exception):
+    pass
+
+
+# One background fetch; the worker reports progress here and the UI polls it
+class Job:
+    def __init__(self, key, label):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.label = label
+        self.status = "queued"  # queued -> running -> done / failed
+        self.total = None
+        self.seeded = 0
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.size = 0
+        self.partitions = None  # per-practice timing for fleet runs
+        self.cancelled = False
+        self.evicted = False  # result dropped from the cache; the job itself stays pollable
+        self._rows = []
+        self._messages = []
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed")
+
+    # ---- worker side ----
+    # Every progress update is also where a cancelled job's worker stops
+    def _check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled(self.error)
+
+    def log(self, text, level="info"):
+        self._check_cancelled()
+        with self._lock:
+            self._messages.append((level, text))
+
+    def set_total(self, total):
+        self._check_cancelled()
+        self.total = total
+
+    def add_total(self, count):
+        self._check_cancelled()
+        with self._lock:
+            self.total = (self.total or 0) + count
+
+    def add_rows(self, rows, seeded=False):
+        """Publish finished rows; ``seeded`` rows were ready up front and don't count toward throughput."""
+        self._check_cancelled()
+        with self._lock:
+            self._rows.extend(rows)
+            if seeded:
+                self.seeded += len(rows)
+
+    # ---- UI side ----
+    def messages(self):
+        with self._lock:
+            return list(self._messages)
+
+    def rows(self):
+        with self._lock:
+            return list(self._rows)
+
+    # Once the result batch is built the progress rows would only be a second copy of it
+    def release_rows(self):
+        with self._lock:
+            self._rows = []
+
+
+# One practice's slice of a fleet job: tags its records and log lines and adds to the shared total
+class PracticeJob:
+    def __init__(self, job, practice):
+        self._job = job
+        self.practice = practice
+
+    def log(self, text, level="info"):
+        if isinstance(text, str):
+            text = f"[{self.practice}] {text}"
+        else:
+            text = {self.practice: text}
+        self._job.log(text, level)
+
+    def set_total(self, total):
+        self._job.add_total(total)
+
+    def add_rows(self, rows, seeded=False):
+        for record in rows:
+            record.practice = self.practice
+        self._job.add_rows(rows, seeded)
+
+
+# Run one practice's pipeline per session concurrently and combine the batches, partitioned by practice
+def run_fleet(job, load_sessions, fn, *args):
+    """Call ``fn(practice_job, *args, practice=..., session=...)`` for every practice.
+
+    ``fn`` returns an ``AppointmentBatch`` and ``load_sessions()`` returns
+    ``{practice: session}``. A practice that fails
+    is logged and left out so the rest of the fleet still completes; the run
+    only fails if every practice does. Timings end up in ``job.partitions``.
+    """
+    sessions = load_sessions()
+    if not sessions:
+        raise RuntimeError("⚠️ No valid sessions found in DB")
+    job.log(f"🏥 Fetching {len(sessions)} practices: {', '.join(sorted(sessions))}")
+
+    def run_practice(practice):
+        started = time.time()
+        try:
+            batch, error = fn(PracticeJob(job, practice), *args, practice=practice, session=sessions[practice]), None
+        except Exception as e:
+            batch, error = None, str(e)
+        return practice, batch or AppointmentBatch.from_records([]), time.time() - started, error
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_PRACTICES, thread_name_prefix="ehr-practice") as pool:
+        results = list(pool.map(run_practice, sorted(sessions)))
+
+    batches = []
+    partitions = []
+    for practice, batch, seconds, error in results:
+        if error:
+            job.log(f"[{practice}] ❌ {error}", "error")
+        batches.append(batch.with_practice(practice))
+        partitions.append({
+            "Practice": practice,
+            "Rows": len(batch),
+            "Seconds": round(seconds, 1),
+            "Status": "failed" if error else "done",
+        })
+    job.partitions = partitions
+
+    if all(error for _, _, _, error in results):
+        raise RuntimeError("Every practice failed; see the log above")
+    return AppointmentBatch.concat(batches)
+
+
+class JobRunner:
+    def __init__(self, max_workers=MAX_CONCURRENT_JOBS):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ehr-job")
+        self._jobs = {}
+        self._in_flight = {}
+        self._results = {}  # key -> id of the latest successful job
+        self._lru = OrderedDict()  # successful job id -> result size, least recently used first
+        self._result_bytes = 0
+        self._lock = threading.Lock()
+
+    def submit(self, key, label, fn, *args, **kwargs):
+        """Queue ``fn(job, *args, **kwargs)`` unless an identical job is already queued or running.
+
+        Returns the new job, or the in-flight job with the same ``key`` so two
+        users asking for the same fetch share one run.
+        """
+        with self._lock:
+            self._prune()
+            job_id = self._in_flight.get(key)
+            if job_id:
+                return self._jobs[job_id]
+
+            job = Job(key, label)
+            self._jobs[job.id] = job
+            self._in_flight[key] = job.id
+
+        self._pool.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            if job_id in self._lru:
+                self._lru.move_to_end(job_id)
+            return self._jobs.get(job_id)
+
+    def cached(self, key, max_age=RESULT_CACHE_TTL_SECONDS):
+        """Return the latest successful job for ``key`` if it finished less than ``max_age`` seconds ago."""
+        with self._lock:
+            job = self._jobs.get(self._results.get(key))
+            if job is None or time.time() - job.finished_at > max_age:
+                return None
+            self._lru.move_to_end(job.id)
+            return job
+
+    def has_jobs(self, prefix):
+        """True if a queued, running or cached job has a key starting with ``prefix``."""
+        with self._lock:
+            return any(key[0] == prefix for key in [*self._in_flight, *self._results])
+
+    def in_flight(self, key):
+        with self._lock:
+            job_id = self._in_flight.get(key)
+            return self._jobs.get(job_id) if job_id else None
+
+    def cancel(self, job_id, reason="Cancelled"):
+        """Fail a queued or running job now and free its key for a new fetch.
+
+        The worker thread stops at its next progress update; whatever it
+        returns after that is discarded.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job and not job.finished:
+                self._cancel(job, reason)
+
+    # Call with the lock held
+    def _cancel(self, job, reason):
+        job.cancelled = True
+        job.error = reason
+        job.finished_at = time.time()
+        job.status = "failed"
+        if self._in_flight.get(job.key) == job.id:
+            del self._in_flight[job.key]
+
+    def _run(self, job, fn, args, kwargs):
+        if job.cancelled:
+            return
+        job.status = "running"
+        job.started_at = time.time()
+        result, size, error = None, 0, None
+        try:
+            result = fn(job, *args, **kwargs)
+            # Rough in-memory footprint, measured once so eviction stays cheap
+            size = result.nbytes if hasattr(result, "nbytes") else len(json.dumps(result, default=str))
+        except Exception as e:
+            error = str(e)
+
+        # finished_at is set before the status flips, so anything that sees a finished job can read it
+        with self._lock:
+            if job.cancelled:
+                job.release_rows()
+                return
+            job.result, job.size, job.error = result, size, error
+            job.finished_at = time.time()
+            job.status = "failed" if error else "done"
+            if self._in_flight.get(job.key) == job.id:
+                del self._in_flight[job.key]
+            if job.status == "done":
+                self._remember(job)
+        job.release_rows()
+
+    # Make ``job`` the cached result for its key, evicting old results past the memory budget; call with the lock held
+    def _remember(self, job):
+        # A refresh replaces the cached result for its key; the old one is never served again
+        previous = self._results.get(job.key)
+        if previous and previous != job.id:
+            self._evict(previous)
+        self._results[job.key] = job.id
+        self._lru[job.id] = job.size
+        self._result_bytes += job.size
+        while self._result_bytes > RESULT_CACHE_MAX_BYTES and len(self._lru) > 1:
+            self._evict(next(iter(self._lru)))
+
+    # Drop a job's result from the cache but keep the job, so sessions polling it see `evicted`; call with the lock held
+    def _evict(self, job_id):
+        self._result_bytes -= self._lru.pop(job_id, 0)
+        job = self._jobs.get(job_id)
+        if job:
+            if self._results.get(job.key) == job_id:
+                del self._results[job.key]
+            job.result = None
+            job.evicted = True
+
+    # Call with the lock held
+    def _forget(self, job_id):
+        self._evict(job_id)
+        self._jobs.pop(job_id, None)
+
+    # Cancel jobs past their deadline and drop finished jobs nobody has polled for a while; call with the lock held
+    def _prune(self):
+        deadline = time.time() - JOB_DEADLINE_SECONDS
+        for job in list(self._jobs.values()):
+            if not job.finished and (job.started_at or job.submitted_at) < deadline:
+                self._cancel(job, f"Timed out after {JOB_DEADLINE_SECONDS // 60} minutes")
+
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        for job_id, job in list(self._jobs.items()):
+            if job.finished and job.finished_at < cutoff:
+                self._forget(job_id)
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+# Process-wide runner shared by every Streamlit session and rerun
+def get_job_runner():
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = JobRunner()
+        return _runner
@@ -1,8 +1,12 @@
+import time
+
+RUN_STARTED = time.perf_counter()  # for the render timing caption at the bottom
+
 import streamlit as st
-import pandas as pd
-import anthropic
 import os
+import re
 from datetime import datetime
+from ehr_ui import render_timing
 
 # Note: dotenv is not needed for Streamlit Cloud, but keeping import for local development
 try:
@@ -11,28 +15,71 @@ try:
 except ImportError:
     pass
 
-# Initialize Anthropic client
-@st.cache_resource
-def get_anthropic_client():
+IMPORTS_DONE = time.perf_counter()
+
+# pandas is imported once a file is uploaded and the Anthropic SDK once notes are generated,
+# so the upload page renders without either
+
+# ---------- CONFIG ----------
+# Simple rows go to the fast tier; complex ones, and fast-tier notes that fail validation, go to the full tier
+MODEL_TIERS = {
+    "fast": {"label": "Haiku 4.5", "model": "claude-haiku-4-5-20251001", "max_tokens": 400},
+    "full": {"label": "Sonnet 4.5", "model": "claude-sonnet-4-5-20250929", "max_tokens": 2000},
+}
+COMPLEXITY_THRESHOLD = 3  # rows scoring at or above this skip the fast tier
+SIGNATURE = "Supahealth (Abbas)"
+PREVIEW_INTERVAL = 0.1  # seconds between live preview redraws
+MAX_LIVE_NOTES = 20  # finished notes shown while the sheet is still being processed
+
+# Columns the note is built from; each one that's missing leaves the model a judgement call
+KEY_COLUMNS = [
+    "Primary Insurance",
+    "Copay/Copay Telehealth/Coinsurance",
+    "Remaining Deductibles & OOP Maximum",
+    "No of Visits",
+]
+FREE_TEXT_COLUMNS = ["Notes", "Remarks"]
+LONG_FREE_TEXT = 200  # characters
+
+def get_api_key():
     # Try Streamlit secrets first (for Cloud), then fall back to environment variables (for local)
     try:
-        api_key = st.secrets["ANTHROPIC_API_KEY"]
+        return st.secrets["ANTHROPIC_API_KEY"]
     except (KeyError, FileNotFoundError):
-        api_key = os.getenv("ANTHROPIC_API_KEY")
-    
-    if not api_key:
-        st.error("⚠️ ANTHROPIC_API_KEY not found in environment variables or secrets")
-        return None
+        return os.getenv("ANTHROPIC_API_KEY")
+
+# Initialize Anthropic client on first use
+@st.cache_resource
+def get_anthropic_client(api_key):
+    import anthropic
+
     return anthropic.Anthropic(api_key=api_key)
 
-def generate_ehr_note(client, row_data):
-    """Generate EHR note using Anthropic API"""
+# Score how much reasoning a row needs: missing fields, free text, and visit-limit arithmetic
+def score_complexity(row_data):
+    score = sum(1 for column in KEY_COLUMNS if not has_value(row_data.get(column)))
+    for column in FREE_TEXT_COLUMNS:
+        value = row_data.get(column)
+        if has_value(value):
+            score += 2 if len(str(value)) < LONG_FREE_TEXT else 3
+    # "22 used of 20" style counts need remaining visits worked out
+    visits = row_data.get("No of Visits")
+    if has_value(visits) and len(re.findall(r"\d+", str(visits))) > 1:
+        score += 2
+    return score
+
+# Check a note follows the fixed format: date first, signature last, no commentary around it
+def validate_note(note):
+    lines = [line.strip() for line in note.strip().splitlines() if line.strip()]
+    if len(lines) < 3 or len(lines) > 12:
+        return False
+    return bool(re.fullmatch(r"\d{2}/\d{2}/\d{4}", lines[0])) and lines[-1] == SIGNATURE
+
+def build_prompt(row_data):
+    """Return the prompt for one row and the context report from ``build_row_context``."""
     
     # Build the row data context
-    row_context = ""
-    for key, value in row_data.items():
-        if pd.notna(value) and key != 'EHR Note' and key != 'Generated EHR Note':
-            row_context += f"{key}: {value}\n"
+    row_context, context_report = build_row_context(row_data)
     
     # Fixed format example
     format_example = """11/07/2025
@@ -61,38 +108,114 @@ Important guidelines:
 2. Include today's date at the top (MM/DD/YYYY format)
 3. Extract policy status, plan type, copay, deductible, OOP, visit limits, and authorization requirements
 4. Be concise and structured
-5. End with "Supahealth (Abbas)"
+5. End with "{SIGNATURE}"
 6. If any information is missing or not provided, use reasonable defaults or omit that line
 7. For visit limits, calculate remaining visits based on available data
 
 Generate ONLY the EHR note text, no additional commentary."""
+    context_report["prompt_tokens"] = estimate_tokens(prompt)
+    return prompt, context_report
+
+def generate_ehr_note(client, prompt, tier="full", on_text=None):
+    """Generate EHR note using Anthropic API, streaming the partial note to ``on_text``
 
+    Returns the note and its timing (time to first token, generation time and
+    token usage), or None for the timing if the call failed.
+    """
     try:
-        message = client.messages.create(
-            model="claude-sonnet-4-5-20250929",
-            max_tokens=2000,
+        started = time.perf_counter()
+        first_token = None
+        text = ""
+        with client.messages.stream(
+            model=MODEL_TIERS[tier]["model"],
+            max_tokens=MODEL_TIERS[tier]["max_tokens"],
             messages=[
                 {"role": "user", "content": prompt}
             ]
-        )
-        return message.content[0].text.strip()
+        ) as stream:
+            for chunk in stream.text_stream:
+                if first_token is None:
+                    first_token = time.perf_counter()
+                text += chunk
+                if on_text:
+                    on_text(text)
+            usage = stream.get_final_message().usage
+        finished = time.perf_counter()
+        first_token = first_token or finished
+        timing = {
+            "ttft": first_token - started,
+            "generating": finished - first_token,
+            "input_tokens": usage.input_tokens,
+            "output_tokens": usage.output_tokens,
+        }
+        return text.strip(), timing
     except Exception as e:
-        return f"Error generating note: {str(e)}"
+        return f"Error generating note: {str(e)}", None
+
+def tokens_per_second(output_tokens, seconds):
+    return round(output_tokens / seconds, 1) if seconds > 0 else None
+
+# Live preview callback for one row; redraws are throttled so the browser keeps up
+def preview_writer(placeholder, label):
+    last_redraw = 0.0
+    def write(text, tier):
+        nonlocal last_redraw
+        now = time.perf_counter()
+        if now - last_redraw >= PREVIEW_INTERVAL:
+            last_redraw = now
+            placeholder.text(f"✍️ {label} · {MODEL_TIERS[tier]['label']}\n\n{text}")
+    return write
+
+# Route a row to a tier by complexity, escalating fast-tier notes that fail validation
+def generate_routed_note(client, row_data, prompt, stats, routing=True, on_text=None):
+    """Return the note for ``prompt``, the tier that produced it and its timing.
+
+    ``stats`` collects per-tier calls, latency, streaming timings and escalations;
+    ``on_text(text, tier)`` receives the partial note as it streams in.
+    """
+    tier = "fast" if routing and score_complexity(row_data) < COMPLEXITY_THRESHOLD else "full"
+    while True:
+        started = time.perf_counter()
+        note, timing = generate_ehr_note(
+            client, prompt, tier, on_text and (lambda text: on_text(text, tier))
+        )
+        tier_stats = stats.setdefault(tier, {
+            "calls": 0, "seconds": 0.0, "rows": 0, "escalated": 0,
+            "timed": 0, "ttft": 0.0, "generating": 0.0, "output_tokens": 0,
+        })
+        tier_stats["calls"] += 1
+        tier_stats["seconds"] += time.perf_counter() - started
+        if timing:
+            tier_stats["timed"] += 1
+            tier_stats["ttft"] += timing["ttft"]
+            tier_stats["generating"] += timing["generating"]
+            tier_stats["output_tokens"] += timing["output_tokens"]
+
+        if tier == "full" or validate_note(note):
+            tier_stats["rows"] += 1
+            return note, tier, timing
+        tier_stats["escalated"] += 1
+        tier = "full"
 
 # ---------- STREAMLIT UI ----------
 st.title("🏥 EHR Notes Generator")
 st.write("Upload an Excel file to generate EHR notes using Anthropic AI")
 
-# Initialize client
-client = get_anthropic_client()
+# Check for an API key up front; the client itself is created when notes are generated
+api_key = get_api_key()
 
-if client is None:
+if not api_key:
+    st.error("⚠️ ANTHROPIC_API_KEY not found in environment variables or secrets")
+    render_timing("ehr_notes_generator", RUN_STARTED, IMPORTS_DONE)
     st.stop()
 
 # File uploader
 uploaded_file = st.file_uploader("Choose an Excel file", type=['xlsx', 'xls'])
 
 if uploaded_file is not None:
+    import pandas as pd
+    from ehr_context import build_row_context, estimate_tokens, full_context_tokens, has_value
+
     try:
         # Read the Excel file
         df = pd.read_excel(uploaded_file)
@@ -116,9 +239,17 @@ if uploaded_file is not None:
             num_rows = st.number_input("Number of rows to process", min_value=1, max_value=len(df), value=min(5, len(df)))
         else:
             num_rows = len(df)
+
+        routing = st.checkbox(
+            "Route simple rows to a faster model",
+            value=True,
+            help=f"Rows with few missing fields and no free-text notes use {MODEL_TIERS['fast']['label']}; "
+                 f"the rest, and any note that doesn't match the format, use {MODEL_TIERS['full']['label']}."
+        )
         
         # Generate button
         if st.button("🚀 Generate EHR Notes", type="primary"):
+            client = get_anthropic_client(api_key)
             
             # Create a copy of the dataframe
             df_result = df.copy()
@@ -132,6 +263,31 @@ if uploaded_file is not None:
             
             # Process rows
             rows_to_process = df.iloc[:num_rows] if not process_all else df
+            tier_stats = {}
+            row_timings = []
+            
+            # Build every prompt up front so the token estimate is known before anything is sent
+            prompts = [build_prompt(row.to_dict()) for _, row in rows_to_process.iterrows()]
+            estimated_tokens = sum(report["prompt_tokens"] for _, report in prompts)
+            context_tokens = sum(report["tokens"] for _, report in prompts)
+            uncompacted_tokens = sum(full_context_tokens(row.to_dict()) for _, row in rows_to_process.iterrows())
+            st.info(
+                f"📏 ~{estimated_tokens:,} input tokens for {num_rows} rows "
+                f"(patient data ~{context_tokens:,} tokens, ~{uncompacted_tokens:,} with every column)"
+            )
+            dropped_columns = sorted({column for _, report in prompts for column in report["dropped"]})
+            truncated_columns = sorted({column for _, report in prompts for column in report["truncated"]})
+            if dropped_columns:
+                st.warning(f"Not sent to the model for some rows: {', '.join(dropped_columns)}")
+            if truncated_columns:
+                st.caption(f"Truncated to fit the per-row budget: {', '.join(truncated_columns)}")
+            
+            # Notes stream into a live preview and are listed as soon as each row finishes
+            preview = st.empty()
+            st.markdown("### Generated Notes")
+            if num_rows > MAX_LIVE_NOTES:
+                st.caption(f"Showing the first {MAX_LIVE_NOTES} notes; all of them are in the results table below")
+            notes_container = st.container()
             
             for idx, (index, row) in enumerate(rows_to_process.iterrows()):
                 status_text.text(f"Processing row {idx + 1} of {num_rows}...")
@@ -139,29 +295,35 @@ if uploaded_file is not None:
                 
                 # Convert row to dict
                 row_data = row.to_dict()
+                row_label = f"Patient: {row_data.get('Patient Name', 'N/A')} - {row_data.get('Appointment date', 'N/A')}"
                 
                 # Generate EHR note
-                generated_note = generate_ehr_note(client, row_data)
+                prompt, context_report = prompts[idx]
+                generated_note, tier, timing = generate_routed_note(
+                    client, row_data, prompt, tier_stats, routing, preview_writer(preview, row_label)
+                )
                 df_result.at[index, 'Generated EHR Note'] = generated_note
+                preview.empty()
+                
+                if idx < MAX_LIVE_NOTES:
+                    with notes_container.expander(row_label):
+                        st.text(generated_note)
+                if timing:
+                    row_timings.append({
+                        "Row": idx + 1,
+                        "Model": MODEL_TIERS[tier]["label"],
+                        "TTFT (s)": round(timing["ttft"], 2),
+                        "Tokens/s": tokens_per_second(timing["output_tokens"], timing["generating"]),
+                        "Est. input tokens": context_report["prompt_tokens"],
+                        "Input tokens": timing["input_tokens"],
+                        "Output tokens": timing["output_tokens"],
+                    })
             
             status_text.text("✅ Processing complete!")
             
             # Show results
             st.subheader("📊 Results")
             
-            # Show sample generated notes
-            st.markdown("### Sample Generated Notes")
-            
-            for idx in range(min(3, num_rows)):
-                row = df_result.iloc[idx]
-                
-                with st.expander(f"Patient: {row.get('Patient Name', 'N/A')} - {row.get('Appointment date', 'N/A')}"):
-                    generated_note = row.get('Generated EHR Note', 'N/A')
-                    if pd.notna(generated_note):
-                        st.text(generated_note)
-                    else:
-                        st.text("(No generated note)")
-            
             # Show full dataframe
             st.markdown("### Full Results Table")
             
@@ -204,6 +366,23 @@ if uploaded_file is not None:
             with col3:
                 errors = df_result['Generated EHR Note'].isna().sum()
                 st.metric("Errors", errors)
+
+            # Per-tier breakdown
+            st.dataframe(pd.DataFrame([
+                {
+                    "Model": MODEL_TIERS[tier]["label"],
+                    "Rows": tier_stats[tier]["rows"],
+                    "Calls": tier_stats[tier]["calls"],
+                    "Escalated": tier_stats[tier]["escalated"],
+                    "Avg latency (s)": round(tier_stats[tier]["seconds"] / tier_stats[tier]["calls"], 2),
+                    "Avg TTFT (s)": round(tier_stats[tier]["ttft"] / tier_stats[tier]["timed"], 2) if tier_stats[tier]["timed"] else None,
+                    "Tokens/s": tokens_per_second(tier_stats[tier]["output_tokens"], tier_stats[tier]["generating"]),
+                }
+                for tier in MODEL_TIERS if tier in tier_stats
+            ]), hide_index=True)
+
+            with st.expander("⏱️ Per-row latency"):
+                st.dataframe(pd.DataFrame(row_timings), hide_index=True)
     
     except Exception as e:
         st.error(f"❌ Error processing file: {str(e)}")
@@ -253,3 +432,4 @@ else:
     ```
     """)
 
+render_timing("ehr_notes_generator", RUN_STARTED, IMPORTS_DONE)
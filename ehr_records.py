@@ -0,0 +1,241 @@
+import json
+import sys
+from dataclasses import dataclass, fields
+from datetime import date, datetime, timedelta
+
+# ---------- CONFIG ----------
+# Low-cardinality text shared by many appointments; interned so 10k rows hold one copy of each value
+CATEGORICAL_FIELDS = ("platform", "practice", "provider", "appointment_type", "appointment_mode", "status")
+EPOCH_UNITS = {"s": 1, "ms": 1000}  # epoch values are divided by this to get seconds
+_EPOCH = datetime(1970, 1, 1)
+
+# Column name -> header shown in the dashboards and written to exports
+COLUMN_LABELS = {
+    "practice": "Practice",
+    "appointment_id": "Appointment ID",
+    "patient_id": "Patient ID",
+    "patient_key": "Patient GUID",
+    "patient_name": "Patient Name",
+    "dob": "DOB",
+    "phone": "Phone",
+    "provider": "Provider",
+    "appointment_type": "Appointment Type",
+    "appointment_mode": "Appointment Mode",
+    "status": "Status",
+    "start_time": "Start Time",
+    "primary_plan": "Primary Insurance",
+    "primary_member_id": "Primary Member ID",
+    "secondary_plan": "Secondary Insurance",
+    "secondary_member_id": "Secondary Member ID",
+    "alert_message": "Alert Message",
+    "transcripts": "All Transcripts",
+    "patient_notes": "Patient Notes",
+    "insurance_raw": "Insurance",
+}
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+# Parse an EHR time value ("YYYY-MM-DD HH:MM:SS", ISO, or epoch in `epoch_unit`) into a naive wall-clock datetime
+def parse_start_time(value, epoch_unit="s"):
+    """Values that can't be parsed are returned unchanged, so one odd row never fails a run."""
+    if value in (None, "", "N/A"):
+        return None
+    try:
+        if isinstance(value, (int, float)):
+            # timedelta handles pre-1970 (negative) values, which fromtimestamp can't on every platform
+            parsed = _EPOCH + timedelta(seconds=value / EPOCH_UNITS[epoch_unit])
+        else:
+            parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except (ValueError, OverflowError, OSError):
+        return value
+    # The EHRs send the practice's wall-clock time; an offset would only mislabel it
+    return parsed.replace(tzinfo=None)
+
+
+def parse_date(value, epoch_unit="s"):
+    parsed = parse_start_time(value, epoch_unit)
+    return parsed.date() if isinstance(parsed, datetime) else parsed
+
+
+@dataclass(slots=True)
+class InsurancePolicy:
+    plan: str | None = None
+    member_id: str | None = None
+
+    def __post_init__(self):
+        self.plan = _intern(self.plan)
+
+    # "Plan - member ID", the way the dashboards have always shown a policy in one cell
+    def summary(self):
+        if self.plan in (None, "N/A") or self.member_id in (None, "N/A"):
+            return "N/A"
+        return f"{self.plan} - {self.member_id}"
+
+
+# One appointment, as produced by either EHR adapter
+@dataclass(slots=True)
+class AppointmentRecord:
+    """Fields an adapter can't fill stay None; "N/A" means the EHR was asked and had nothing.
+
+    Practice Fusion's enrichment stages (``primary``/``secondary``/``insurance_raw``,
+    ``transcripts``, ``patient_notes``) stay None until that stage has run.
+    """
+
+    platform: str
+    appointment_id: str
+    patient_key: str | None = None
+    patient_id: str | None = None
+    patient_name: str | None = None
+    dob: date | str | None = None  # the raw value when it isn't a date
+    phone: str | None = None
+    provider: str | None = None
+    appointment_type: str | None = None
+    appointment_mode: str | None = None
+    status: str | None = None
+    start_time: datetime | str | None = None  # naive wall-clock time, or the raw value when it can't be parsed
+    primary: InsurancePolicy | None = None
+    secondary: InsurancePolicy | None = None
+    alert_message: str | None = None
+    transcripts: str | None = None
+    patient_notes: str | None = None
+    insurance_raw: dict | None = None
+    practice: str | None = None
+
+    def __post_init__(self):
+        for name in CATEGORICAL_FIELDS:
+            setattr(self, name, _intern(getattr(self, name)))
+
+    # Typed start time for DB columns; None when the EHR's value couldn't be parsed
+    @property
+    def start_timestamp(self):
+        return self.start_time if isinstance(self.start_time, datetime) else None
+
+    @property
+    def appointment_date(self):
+        return self.start_timestamp.date() if self.start_timestamp else None
+
+    # Plain JSON-safe dict, for snapshots and the row details view
+    def to_json(self):
+        data = {}
+        for field in fields(self):
+            value = getattr(self, field.name)
+            if isinstance(value, InsurancePolicy):
+                value = {"plan": value.plan, "member_id": value.member_id}
+            elif isinstance(value, date):
+                value = value.isoformat()
+            data[field.name] = value
+        return data
+
+    @classmethod
+    def from_json(cls, data):
+        data = dict(data)
+        for name in ("primary", "secondary"):
+            if data.get(name) is not None:
+                data[name] = InsurancePolicy(**data[name])
+        if data.get("dob"):
+            try:
+                data["dob"] = date.fromisoformat(data["dob"])
+            except ValueError:
+                pass
+        data["start_time"] = parse_start_time(data.get("start_time"))
+        return cls(**data)
+
+
+def _policy_getter(name, attr):
+    return lambda record: getattr(getattr(record, name), attr) if getattr(record, name) else None
+
+
+# Column name -> how to read it off a record; insurance policies are flattened into two columns each
+_COLUMN_GETTERS = {
+    name: (lambda record, name=name: getattr(record, name))
+    for name in COLUMN_LABELS
+    if not name.startswith(("primary_", "secondary_"))
+}
+for _name in ("primary", "secondary"):
+    _COLUMN_GETTERS[f"{_name}_plan"] = _policy_getter(_name, "plan")
+    _COLUMN_GETTERS[f"{_name}_member_id"] = _policy_getter(_name, "member_id")
+_COLUMN_GETTERS["platform"] = lambda record: record.platform
+
+
+# A finished result: one list per column instead of one dict per row
+class AppointmentBatch:
+    """Column-oriented appointments that convert straight to Arrow/pandas.
+
+    Build one with ``from_records`` once a run is done; the records can then be
+    dropped. ``record(i)`` rebuilds a single row for the details view.
+    """
+
+    __slots__ = ("columns", "_length")
+
+    def __init__(self, columns, length):
+        self.columns = columns
+        self._length = length
+
+    @classmethod
+    def from_records(cls, records):
+        records = list(records)
+        return cls({name: [get(record) for record in records] for name, get in _COLUMN_GETTERS.items()}, len(records))
+
+    @classmethod
+    def concat(cls, batches):
+        return cls(
+            {name: [value for batch in batches for value in batch.columns[name]] for name in _COLUMN_GETTERS},
+            sum(len(batch) for batch in batches),
+        )
+
+    def __len__(self):
+        return self._length
+
+    def with_practice(self, practice):
+        return AppointmentBatch({**self.columns, "practice": [_intern(practice)] * self._length}, self._length)
+
+    def record(self, i):
+        values = {name: column[i] for name, column in self.columns.items()}
+        for name in ("primary", "secondary"):
+            plan, member_id = values.pop(f"{name}_plan"), values.pop(f"{name}_member_id")
+            values[name] = None if plan is None and member_id is None else InsurancePolicy(plan, member_id)
+        return AppointmentRecord(**values)
+
+    # Rough in-memory footprint; interned values are counted once
+    @property
+    def nbytes(self):
+        seen = set()
+        size = 0
+        for column in self.columns.values():
+            size += sys.getsizeof(column)
+            for value in column:
+                if value is not None and id(value) not in seen:
+                    seen.add(id(value))
+                    size += sys.getsizeof(value)
+        return size
+
+    def column_names(self, names=None):
+        """``names`` (default: every labelled column), with Practice up front when the batch has one."""
+        names = list(names or COLUMN_LABELS)
+        if "practice" not in names and any(value is not None for value in self.columns["practice"]):
+            names.insert(0, "practice")
+        return names
+
+    def to_arrow(self, names=None):
+        import pyarrow as pa
+
+        names = self.column_names(names)
+        return pa.table([_arrow_column(self.columns[name]) for name in names], names=[COLUMN_LABELS[name] for name in names])
+
+    def to_pandas(self, names=None):
+        return self.to_arrow(names).to_pandas()
+
+
+# Nested values (e.g. the raw Insurance payload) become JSON text; mixed-type columns fall back to text
+def _arrow_column(values):
+    import pyarrow as pa
+
+    if any(isinstance(value, (dict, list)) for value in values):
+        values = [json.dumps(value, default=str) if isinstance(value, (dict, list)) else value for value in values]
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([None if value is None else str(value) for value in values], type=pa.string())
@@ -0,0 +1,152 @@
+import csv
+import io
+import json
+import threading
+from datetime import date, datetime
+
+# ---------- CONFIG ----------
+SCHEMA = "ehr_schema"
+BATCH_SIZE = 5000
+
+_ensured_tables = set()  # tables already created by this process, so their DDL runs once
+_ddl_lock = threading.Lock()  # fleet practices persist at the same time; concurrent CREATE TABLE IF NOT EXISTS collides
+
+
+def _csv_value(value):
+    if value is None:
+        return None
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def _key_columns(key):
+    return [key] if isinstance(key, str) else list(key)
+
+
+# Create the table and its lookup indexes if they don't exist yet
+def ensure_table(conn, table, columns, key, indexes):
+    """``columns`` is a list of ``(name, sql_type, extractor)`` tuples; ``key`` is a column or a list of them.
+
+    Tables created by an older version get any missing columns, and their
+    primary key is moved to ``key`` if it changed.
+    """
+    with _ddl_lock:
+        if table not in _ensured_tables:
+            _create_table(conn, table, columns, key, indexes)
+            _ensured_tables.add(table)
+
+
+def _create_table(conn, table, columns, key, indexes):
+    # psycopg2 is imported on first write so the dashboards render without it
+    from psycopg2 import sql
+
+    key = _key_columns(key)
+    target = sql.SQL("{}.{}").format(sql.Identifier(SCHEMA), sql.Identifier(table))
+    key_list = sql.SQL(", ").join(sql.Identifier(name) for name in key)
+    column_defs = [
+        sql.SQL("{} {}").format(sql.Identifier(name), sql.SQL(sql_type))
+        for name, sql_type, _ in columns
+    ]
+    column_defs.append(sql.SQL("fetched_at TIMESTAMPTZ NOT NULL DEFAULT NOW()"))
+    column_defs.append(sql.SQL("PRIMARY KEY ({})").format(key_list))
+
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {}").format(sql.Identifier(SCHEMA)))
+        cur.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {} ({})").format(target, sql.SQL(", ").join(column_defs)))
+        for name, sql_type, _ in columns:
+            cur.execute(sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} {}").format(
+                target, sql.Identifier(name), sql.SQL(sql_type)
+            ))
+
+        cur.execute("""
+            SELECT c.conname, array_agg(a.attname::text ORDER BY array_position(c.conkey, a.attnum))
+            FROM pg_constraint c JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = ANY(c.conkey)
+            WHERE c.conrelid = %s::regclass AND c.contype = 'p'
+            GROUP BY c.conname
+        """, (f"{SCHEMA}.{table}",))
+        primary_key = cur.fetchone()
+        if primary_key and primary_key[1] != key:
+            cur.execute(sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}, ADD PRIMARY KEY ({})").format(
+                target, sql.Identifier(primary_key[0]), key_list
+            ))
+
+        for column in indexes:
+            cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {}.{} ({})").format(
+                sql.Identifier(f"{table}_{column}_idx"),
+                sql.Identifier(SCHEMA), sql.Identifier(table), sql.Identifier(column)
+            ))
+    conn.commit()
+
+
+# Bulk upsert rows: COPY each batch into a temp table, then merge it into the target
+def persist_rows(conn, table, columns, key, rows, indexes=(), batch_size=BATCH_SIZE, keep_existing=()):
+    """Write ``rows`` into ``ehr_schema.<table>`` and return how many were written.
+
+    Each extractor in ``columns`` turns one row into the value for its column.
+    Rows with the same ``key`` (a column or a list of them) replace the stored row, so re-running a date range
+    refreshes it in place. Columns in ``keep_existing`` (e.g. optional
+    enrichment stages) are only overwritten by non-NULL values.
+    """
+    from psycopg2 import sql
+
+    ensure_table(conn, table, columns, key, indexes)
+
+    key = _key_columns(key)
+    key_list = sql.SQL(", ").join(sql.Identifier(name) for name in key)
+    names = [name for name, _, _ in columns]
+    column_list = sql.SQL(", ").join(sql.Identifier(name) for name in names)
+    updates = sql.SQL(", ").join(
+        sql.SQL("{0} = COALESCE(EXCLUDED.{0}, existing.{0})" if name in keep_existing else "{0} = EXCLUDED.{0}").format(
+            sql.Identifier(name)
+        )
+        for name in names if name not in key
+    )
+    target = sql.SQL("{}.{}").format(sql.Identifier(SCHEMA), sql.Identifier(table))
+    staging = sql.Identifier(f"{table}_staging")
+
+    written = 0
+    with conn.cursor() as cur:
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for row in batch:
+                writer.writerow([_csv_value(extract(row)) for _, _, extract in columns])
+            buffer.seek(0)
+
+            cur.execute(sql.SQL(
+                "CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP"
+            ).format(staging, target))
+            cur.copy_expert(
+                sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(staging, column_list).as_string(conn),
+                buffer
+            )
+            # DISTINCT ON keeps one row per key so the upsert never touches a row twice
+            cur.execute(sql.SQL("""
+                INSERT INTO {target} AS existing ({columns}, fetched_at)
+                SELECT DISTINCT ON ({key}) {columns}, NOW() FROM {staging}
+                ON CONFLICT ({key}) DO UPDATE SET {updates}, fetched_at = EXCLUDED.fetched_at
+            """).format(
+                target=target, columns=column_list, key=key_list,
+                staging=staging, updates=updates
+            ))
+            conn.commit()
+            written += len(batch)
+
+    return written
+
+
+# Upsert a run's records and report the outcome in its log; a failed write doesn't fail the run
+def save_records(job, connect, table, columns, key, records, indexes=(), keep_existing=()):
+    conn = connect()
+    try:
+        written = persist_rows(conn, table, columns, key, records, indexes, keep_existing=keep_existing)
+        job.log(f"💾 Saved {written} rows to {SCHEMA}.{table}")
+    except Exception as e:
+        job.log(f"Failed to save results to database: {str(e)}", "error")
+    finally:
+        conn.close()
@@ -0,0 +1,242 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from ehr_records import AppointmentRecord
+
+# ---------- CONFIG ----------
+SNAPSHOT_DIR = os.getenv("EHR_SNAPSHOT_DIR", ".ehr_snapshots")
+SNAPSHOT_RETENTION_DAYS = 14
+REUSE_MAX_AGE_HOURS = 24  # older enrichment (insurance, alerts, ...) is fetched again even if the appointment is unchanged
+# Bump whenever the stored row shape changes so old snapshots are discarded
+SNAPSHOT_VERSION = 5
+
+_path_locks = {}
+_path_locks_guard = threading.Lock()
+
+
+# Jobs run concurrently, so every read-merge-write of one file goes through that file's lock
+def _path_lock(path):
+    with _path_locks_guard:
+        return _path_locks.setdefault(path, threading.Lock())
+
+
+# Write JSON through a uniquely named temp file so concurrent writers never share one
+def _write_json(path, data):
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=SNAPSHOT_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, default=str)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# `platform` may carry a practice ID from the DB, so keep it to safe filename characters
+def _snapshot_path(platform):
+    return os.path.join(SNAPSHOT_DIR, re.sub(r"[^\w.-]", "_", f"{platform}.json"))
+
+
+def empty_snapshot():
+    return {"version": SNAPSHOT_VERSION, "synced_at": None, "appointments": {}}
+
+
+# Load the last fetched snapshot for a platform
+def load_snapshot(platform):
+    try:
+        with open(_snapshot_path(platform)) as f:
+            snapshot = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return empty_snapshot()
+    if not isinstance(snapshot, dict) or snapshot.get("version") != SNAPSHOT_VERSION:
+        return empty_snapshot()
+    return snapshot
+
+
+# Merge this run's appointments into the stored snapshot
+def save_snapshot(platform, entries):
+    """Store ``entries`` (appointment key -> entry) on top of the snapshot on disk.
+
+    The snapshot is re-read under a lock, so runs that finish at the same time
+    all keep their entries. Appointments outside the current date range are
+    kept so a later run over a different window can still reuse them; anything
+    not seen for ``SNAPSHOT_RETENTION_DAYS`` is dropped.
+    """
+    path = _snapshot_path(platform)
+    with _path_lock(path):
+        now = time.time()
+        cutoff = now - SNAPSHOT_RETENTION_DAYS * 86400
+        appointments = {
+            key: entry
+            for key, entry in load_snapshot(platform).get("appointments", {}).items()
+            if entry.get("seen_at", 0) >= cutoff
+        }
+        for key, entry in entries.items():
+            entry["seen_at"] = now
+            appointments[key] = _merge_entry(appointments.get(key), entry)
+
+        _write_json(path, {"version": SNAPSHOT_VERSION, "synced_at": now, "appointments": appointments})
+
+
+# Stable hash of the raw appointment payload
+def appointment_fingerprint(appt):
+    raw = json.dumps(appt, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def snapshot_entry(appt, patient_key, row, stages=()):
+    now = time.time()
+    return {
+        "fingerprint": appointment_fingerprint(appt),
+        "patient": patient_key,
+        "row": row,
+        "stages": {stage: now for stage in stages},  # stage -> when it was last fetched
+        "enriched_at": now,
+    }
+
+
+# A run with fewer stages keeps what an earlier run loaded for the same appointment payload
+def _merge_entry(stored, entry):
+    if not stored or stored.get("fingerprint") != entry["fingerprint"]:
+        return entry
+    row = dict(entry["row"])
+    for column, value in stored.get("row", {}).items():
+        if row.get(column) is None:
+            row[column] = value
+    return {**entry, "row": row, "stages": {**stored.get("stages", {}), **entry["stages"]}}
+
+
+# Diff a fresh schedule against the snapshot by appointment ID
+def diff_appointments(appointments, snapshot, key_fn, patient_fn, stages=(), max_age_hours=REUSE_MAX_AGE_HOURS):
+    """Return the snapshot entries that can be reused as-is, keyed by appointment.
+
+    An appointment is reusable when its payload is unchanged, the stored row
+    and each of the requested ``stages`` were fetched less than
+    ``max_age_hours`` ago, and none of the patient's other appointments in this
+    fetch are new, changed or expired, so every patient that does need
+    enrichment is refreshed for all of their rows.
+    """
+    stored = snapshot.get("appointments", {})
+    cutoff = time.time() - max_age_hours * 3600
+    unchanged = {}
+    stale_patients = set()
+    for appt in appointments:
+        key = key_fn(appt)
+        entry = stored.get(key)
+        if (
+            entry
+            and entry.get("fingerprint") == appointment_fingerprint(appt)
+            and entry.get("enriched_at", 0) >= cutoff
+            and all(entry.get("stages", {}).get(stage, 0) >= cutoff for stage in stages)
+        ):
+            unchanged[key] = entry
+        else:
+            stale_patients.add(patient_fn(appt))
+
+    return {
+        key: entry
+        for key, entry in unchanged.items()
+        if entry.get("patient") not in stale_patients
+    }
+
+
+# One run's incremental bookkeeping: what the last sync already has, what still needs enriching, and the new snapshot
+class IncrementalSync:
+    """Seeds a run from the snapshot ``name`` and saves it again at the end.
+
+    ``rows_by_key`` starts with the reusable records (appointment key ->
+    record) and ``pending`` groups every other appointment by patient, so each
+    patient is enriched once.
+    """
+
+    def __init__(self, job, name, appointments, key_fn, patient_fn, incremental, practice=None, stages=()):
+        self.name = name
+        self._appointments = appointments
+        self._key_fn = key_fn
+        self._patient_fn = patient_fn
+        self._stages = stages
+        snapshot = load_snapshot(name) if incremental else empty_snapshot()
+        self._reused = diff_appointments(appointments, snapshot, key_fn, patient_fn, stages)
+        self.rows_by_key = {
+            key: AppointmentRecord.from_json({**entry["row"], "practice": practice})
+            for key, entry in self._reused.items()
+        }
+        if incremental:
+            job.log(f"♻️ Reusing {len(self.rows_by_key)} unchanged appointments from the last sync")
+
+        self.pending = {}
+        for appt in appointments:
+            if key_fn(appt) not in self.rows_by_key:
+                self.pending.setdefault(patient_fn(appt), []).append(appt)
+        # Unchanged rows are ready now
+        job.add_rows(list(self.rows_by_key.values()), seeded=True)
+
+    def enrich(self, job, fetch_details, build_record, max_workers):
+        """Call ``fetch_details(patient)`` for each pending patient on a thread pool, then
+        ``build_record(appointment, details)`` for each of their appointments.
+
+        Rows are published to ``job`` as each patient finishes. Returns patient -> details.
+        """
+        details_by_patient = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(fetch_details, patient): patient for patient in self.pending}
+            try:
+                for future in as_completed(futures):
+                    patient = futures[future]
+                    details = details_by_patient[patient] = future.result()
+                    new_rows = []
+                    for appt in self.pending[patient]:
+                        record = build_record(appt, details)
+                        self.rows_by_key[self._key_fn(appt)] = record
+                        new_rows.append(record)
+                    job.add_rows(new_rows)
+            except BaseException:
+                # A failed or cancelled run doesn't wait for the patients that haven't started
+                pool.shutdown(cancel_futures=True)
+                raise
+        return details_by_patient
+
+    def finish(self):
+        """Save the snapshot and return every record in schedule order."""
+        data = []
+        entries = {}
+        for appt in self._appointments:
+            key = self._key_fn(appt)
+            record = self.rows_by_key[key]
+            data.append(record)
+            # Reused entries are stored as they were, so they keep their original enrichment time
+            entries[key] = self._reused.get(key) or snapshot_entry(appt, self._patient_fn(appt), record.to_json(), self._stages)
+        save_snapshot(self.name, entries)
+        return data
+
+
+def _catalog_path(platform):
+    return os.path.join(SNAPSHOT_DIR, f"{platform}.catalog.json")
+
+
+# Lookup values (e.g. filter options) seen in past fetches, kept apart from the snapshot so the UI can load them cheaply
+def load_catalog(platform):
+    try:
+        with open(_catalog_path(platform)) as f:
+            catalog = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    return catalog if isinstance(catalog, dict) else {}
+
+
+def save_catalog(platform, catalog):
+    """Merge ``catalog`` (group -> {value: label}) into the stored one, so filtered runs don't shrink it."""
+    path = _catalog_path(platform)
+    with _path_lock(path):
+        merged = load_catalog(platform)
+        for group, values in catalog.items():
+            merged.setdefault(group, {}).update(values)
+        _write_json(path, merged)
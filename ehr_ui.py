@@ -0,0 +1,278 @@
+import hashlib
+import math
+import time
+
+import streamlit as st
+
+from ehr_jobs import get_job_runner, run_fleet
+from ehr_records import AppointmentBatch
+from ehr_sync import REUSE_MAX_AGE_HOURS
+
+# pandas and pyarrow are imported inside the functions that draw results, so a page
+# with nothing to show yet never loads them
+
+# ---------- CONFIG ----------
+POLL_INTERVAL = 1.0  # seconds between redraws while a job is running
+SESSION_IDENTITY_TTL = 60  # seconds; keeps reruns from hitting the sessions table on every click
+PAGE_SIZES = [50, 100, 500, 1000]  # rows sent to the browser per page
+MAX_FILTER_VALUES = 500  # columns with more distinct values are searched instead of filtered
+ROW_COLUMN = "__row"  # position in the job result, so selections survive filtering and sorting
+SEARCH_COLUMN = "__search"  # every column joined and lowercased, so search is one scan
+STARTUP_BUDGET_SECONDS = 1.0  # first render of a dashboard in a fresh process
+
+_first_renders = {}  # script -> timings of its first run in this process
+
+
+# Short hash of the current DB session(s), so cached results are never shared across logins
+@st.cache_data(ttl=SESSION_IDENTITY_TTL, show_spinner=False)
+def session_identity(scope, _load_session):
+    session = _load_session()
+    if not session:
+        return None
+    return hashlib.sha1(repr(session).encode("utf-8")).hexdigest()[:12]
+
+
+# Fetch button, plus "cached N minutes ago" and a Refresh button when this query was fetched recently
+def fetch_controls(label, cached_job):
+    """Return "fetch", "refresh" or None depending on which button was clicked."""
+    if cached_job is None:
+        return "fetch" if st.button(label) else None
+
+    fetch_col, refresh_col, caption_col = st.columns([2, 1, 4], vertical_alignment="center")
+    fetch = fetch_col.button(label)
+    refresh = refresh_col.button("Refresh", help="Ignore the cached results and fetch again from the EHR.")
+    minutes = int((time.time() - cached_job.finished_at) // 60)
+    caption_col.caption("Cached just now" if minutes == 0 else f"Cached {minutes} minute{'s' if minutes != 1 else ''} ago")
+    if refresh:
+        return "refresh"
+    return "fetch" if fetch else None
+
+
+# Options every dashboard's fetch has; returns (incremental, progressive, save_to_db, fleet)
+def sync_options(db_table):
+    incremental = st.checkbox(
+        "Incremental sync",
+        value=True,
+        help=f"Only enrich appointments that are new or changed since the last run; unchanged rows enriched in the last {REUSE_MAX_AGE_HOURS} hours are reused."
+    )
+    progressive = st.checkbox(
+        "Show rows as they arrive",
+        value=True,
+        help="Fill the table in batches while patients are still being enriched."
+    )
+    save_to_db = st.checkbox(
+        "Save results to database",
+        value=False,
+        help=f"Upsert the enriched rows into ehr_schema.{db_table}."
+    )
+    fleet = st.checkbox(
+        "All practices",
+        value=False,
+        help="Fetch every practice with a valid session in parallel and combine the results, with a Practice column."
+    )
+    return incremental, progressive, save_to_db, fleet
+
+
+# Fetch button, background job and its progress; returns the job once it has finished successfully
+def fetch_job(platform, label, query, run_sync, sync_args, get_latest_session, list_practice_sessions, fleet, progressive, columns):
+    """Run ``run_sync(job, *sync_args)`` in the background, for every practice with ``fleet``.
+
+    ``query`` (hashable) identifies the request together with the platform and
+    the current sessions: identical requests share one job, and its result is
+    cached for a while. ``columns`` are the result columns shown while it runs.
+    """
+    runner = get_job_runner()
+    sessions_scope, load_sessions = (
+        (f"{platform}:fleet", list_practice_sessions) if fleet else (platform, get_latest_session)
+    )
+
+    # The session lookup needs the DB, so it's skipped until this platform has a job to match against
+    def job_key():
+        return (platform, fleet, session_identity(sessions_scope, load_sessions), *query)
+
+    known_queries = runner.has_jobs(platform)
+    cached_job = runner.cached(job_key()) if known_queries else None
+
+    action = fetch_controls(label, cached_job)
+    if action == "fetch" and cached_job:
+        st.session_state["job_id"] = cached_job.id
+    elif action:
+        if fleet:
+            job = runner.submit(job_key(), "Fetching data for all practices", run_fleet, list_practice_sessions, run_sync, *sync_args)
+        else:
+            job = runner.submit(job_key(), "Fetching data", run_sync, *sync_args)
+        st.session_state["job_id"] = job.id
+
+    # Re-attach to this session's job, or to an identical fetch someone else already started; a job whose
+    # result was evicted or replaced by a Refresh falls back to the latest one for this query
+    job = runner.get(st.session_state.get("job_id"))
+    if (job is None or job.evicted) and known_queries:
+        job = runner.cached(job_key()) or runner.in_flight(job_key()) or job
+
+    if job and job.evicted:
+        st.info("These results were dropped from the cache to free memory; fetch again to reload them.")
+    elif job and not job.finished:
+        job_monitor(job.id, progressive, columns)
+    elif job:
+        job_summary(job, "✅ All data fetched successfully!")
+        if job.status == "done":
+            return job
+    return None
+
+
+# "120/300 rows · 4.2 rows/s · ETA 43s"
+def progress_caption(job, done):
+    if job.total is None:
+        return "Waiting for the schedule..."
+
+    progress = f"{done}/{job.total} rows"
+    elapsed = time.time() - (job.started_at or job.submitted_at)
+    enriched = done - job.seeded
+    if enriched and elapsed > 0:
+        rate = enriched / elapsed
+        progress += f" · {rate:.1f} rows/s"
+        remaining = job.total - done
+        if remaining > 0:
+            progress += f" · ETA {remaining / rate:.0f}s"
+    return progress
+
+
+def show_job_log(job):
+    for level, text in job.messages():
+        if level == "report":
+            st.json(text, expanded=False)
+        elif level == "error":
+            st.error(text)
+        elif level == "warning":
+            st.warning(text)
+        else:
+            st.write(text)
+
+
+# Poll a running job; redraws are throttled to POLL_INTERVAL so the browser never becomes the bottleneck
+@st.fragment(run_every=POLL_INTERVAL)
+def job_monitor(job_id, show_rows=True, columns=None):
+    job = get_job_runner().get(job_id)
+    if job is None or job.finished:
+        # Rerun the whole page so it can draw the final results
+        st.rerun()
+
+    with st.status(f"{job.label}...", expanded=True, state="running"):
+        show_job_log(job)
+    if st.button("Cancel", key=f"cancel_{job_id}", help="Stop this fetch; it is stopped for everyone sharing it."):
+        get_job_runner().cancel(job_id)
+        st.rerun()
+
+    rows = job.rows()
+    st.caption(progress_caption(job, len(rows)))
+    if show_rows and rows:
+        # Only the newest page goes to the browser; the full table is shown once the job finishes
+        st.dataframe(AppointmentBatch.from_records(rows[-PAGE_SIZES[0]:]).to_pandas(columns), hide_index=True)
+
+
+# Status box for a finished job
+def job_summary(job, success_label):
+    import pandas as pd
+
+    elapsed = (job.finished_at or time.time()) - (job.started_at or job.submitted_at)
+    if job.status == "done":
+        with st.status(success_label, expanded=False, state="complete"):
+            show_job_log(job)
+        st.caption(f"Finished in {elapsed:.1f}s")
+        if job.partitions:
+            st.dataframe(pd.DataFrame(job.partitions), hide_index=True)
+    else:
+        with st.status(f"{job.label} failed", expanded=True, state="error"):
+            show_job_log(job)
+        st.error(job.error)
+        if job.partitions:
+            st.dataframe(pd.DataFrame(job.partitions), hide_index=True)
+
+
+# Build the Arrow table for a finished job once; it stays on the server and is shared by every session
+@st.cache_resource(max_entries=8, show_spinner=False)
+def results_table(job_id, _batch, columns=None):
+    """``_batch`` is the job's ``AppointmentBatch``; ``columns`` picks and orders what is shown."""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    table = _batch.to_arrow(columns)
+
+    text = [pc.fill_null(pc.cast(column, pa.string()), "") for column in table.columns]
+    search = pc.utf8_lower(pc.binary_join_element_wise(*text, "\x1f")) if text else pa.nulls(len(_batch), pa.string())
+    return table.append_column(ROW_COLUMN, pa.array(range(len(_batch)), pa.int64())).append_column(SEARCH_COLUMN, search)
+
+
+@st.cache_resource(max_entries=8, show_spinner=False)
+def results_csv(job_id, _table):
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+
+    buffer = pa.BufferOutputStream()
+    pa_csv.write_csv(_table.drop_columns([ROW_COLUMN, SEARCH_COLUMN]), buffer)
+    return buffer.getvalue().to_pybytes()
+
+
+# Search, filter, sort and page a results table in Arrow; only the visible page is sent to the browser
+def paged_table(table, key, selectable=False):
+    """Show ``table`` (from ``results_table``) one page at a time.
+
+    Returns the result positions of the selected rows when ``selectable``.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    columns = [column for column in table.column_names if column not in (ROW_COLUMN, SEARCH_COLUMN)]
+
+    search_col, sort_col, order_col = st.columns([3, 2, 1], vertical_alignment="bottom")
+    query = search_col.text_input("Search", key=f"{key}_search", placeholder="Search all columns")
+    sort_by = sort_col.selectbox("Sort by", [None] + columns, key=f"{key}_sort", format_func=lambda c: c or "—")
+    descending = order_col.toggle("Descending", key=f"{key}_descending")
+
+    with st.expander("Filter"):
+        filter_by = st.selectbox("Column", [None] + columns, key=f"{key}_filter", format_func=lambda c: c or "—")
+        values = []
+        if filter_by:
+            options = pc.unique(table[filter_by])
+            if len(options) <= MAX_FILTER_VALUES:
+                values = st.multiselect("Values", options.drop_null().to_pylist(), key=f"{key}_filter_values")
+            else:
+                st.caption(f"{filter_by} has more than {MAX_FILTER_VALUES} distinct values; use search instead.")
+
+    view = table
+    if values:
+        view = view.filter(pc.is_in(view[filter_by], value_set=pa.array(values, type=view[filter_by].type)))
+    if query:
+        view = view.filter(pc.match_substring(view[SEARCH_COLUMN], query.lower()))
+    if sort_by:
+        view = view.sort_by([(sort_by, "descending" if descending else "ascending")])
+
+    size_col, page_col, caption_col = st.columns([1, 1, 4], vertical_alignment="bottom")
+    page_size = size_col.selectbox("Rows per page", PAGE_SIZES, key=f"{key}_page_size")
+    pages = max(1, math.ceil(view.num_rows / page_size))
+    # Searching or filtering can shrink the result below the current page
+    if st.session_state.get(f"{key}_page", 1) > pages:
+        st.session_state[f"{key}_page"] = pages
+    page = page_col.number_input("Page", min_value=1, max_value=pages, key=f"{key}_page")
+    caption_col.caption(f"{view.num_rows} of {table.num_rows} rows · page {page} of {pages}")
+
+    page_view = view.slice((page - 1) * page_size, page_size)
+    df = page_view.drop_columns([ROW_COLUMN, SEARCH_COLUMN]).to_pandas()
+    if not selectable:
+        st.dataframe(df, hide_index=True)
+        return []
+
+    event = st.dataframe(df, hide_index=True, on_select="rerun", selection_mode="multi-row", key=f"{key}_table")
+    positions = page_view[ROW_COLUMN].to_pylist()
+    return [positions[i] for i in event.selection.rows if i < len(positions)]
+
+
+# Sidebar timing report: this run, and the script's first (cold) run in this process against the budget
+def render_timing(script, started, imports_done):
+    run = {"imports": imports_done - started, "total": time.perf_counter() - started}
+    first = _first_renders.setdefault(script, run)
+    verdict = "within budget" if first["total"] <= STARTUP_BUDGET_SECONDS else "⚠️ over budget"
+    st.sidebar.caption(
+        f"⏱️ First render {first['total']:.2f}s (imports {first['imports']:.2f}s, {verdict}) · "
+        f"this run {run['total']:.2f}s"
+    )
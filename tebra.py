@@ -1,18 +1,75 @@
-import streamlit as st
-import requests
-import pandas as pd
-import psycopg2
-import os
 import time
+
+RUN_STARTED = time.perf_counter()  # for the render timing caption at the bottom
+
+import streamlit as st
+import sys
+import argparse
 from datetime import date, datetime, timedelta
 from dotenv import load_dotenv
+from ehr_sync import REUSE_MAX_AGE_HOURS, IncrementalSync, load_catalog, save_catalog
+from ehr_store import SCHEMA, ensure_table, persist_rows, save_records
+from ehr_records import AppointmentBatch, AppointmentRecord, InsurancePolicy, parse_date, parse_start_time
+from ehr_http import SessionExpired, open_client
+from ehr_ui import SESSION_IDENTITY_TTL, fetch_job, paged_table, render_timing, results_csv, results_table, sync_options
+
+IMPORTS_DONE = time.perf_counter()
 
 load_dotenv()  # Load environment variables from .env file
 
 # ---------- CONFIG ----------
 BASE_URL = "https://app.kareo.com"
+PLATFORM = "tebra"
+MAX_WORKERS = 4  # concurrent per-patient enrichment calls; each still sleeps 0.1s for rate limiting
+RATE_LIMIT = 10  # requests per second, per practice
+RESULT_COLUMNS = [  # AppointmentBatch columns shown in the results table and CSV, in order
+    "appointment_id", "patient_id", "patient_key", "patient_name", "dob", "provider", "start_time",
+    "appointment_type", "appointment_mode", "primary_plan", "primary_member_id", "secondary_plan",
+    "secondary_member_id", "alert_message", "phone",
+]
+
+# Enriched rows are upserted into ehr_schema.<DB_TABLE>
+DB_TABLE = "tebra_appointments"
+DB_COLUMNS = [
+    # Fleet runs share the table, so rows are keyed per practice (see DB_KEY)
+    ("practice", "TEXT NOT NULL DEFAULT 'default'", lambda record: record.practice or "default"),
+    ("appointment_id", "TEXT", lambda record: record.appointment_id),
+    ("patient_id", "TEXT", lambda record: record.patient_id),
+    ("patient_guid", "TEXT", lambda record: record.patient_key),
+    ("patient_name", "TEXT", lambda record: record.patient_name),
+    ("dob", "TEXT", lambda record: record.dob),
+    ("provider", "TEXT", lambda record: record.provider),
+    ("start_time", "TIMESTAMP", lambda record: record.start_timestamp),
+    ("appointment_date", "DATE", lambda record: record.appointment_date),
+    ("appointment_type", "TEXT", lambda record: record.appointment_type),
+    ("appointment_mode", "TEXT", lambda record: record.appointment_mode),
+    ("primary_insurance", "TEXT", lambda record: record.primary.plan),
+    ("primary_policy_number", "TEXT", lambda record: record.primary.member_id),
+    ("secondary_insurance", "TEXT", lambda record: record.secondary.plan),
+    ("secondary_policy_number", "TEXT", lambda record: record.secondary.member_id),
+    ("alert_message", "TEXT", lambda record: record.alert_message),
+    ("phone", "TEXT", lambda record: record.phone),
+]
+DB_KEY = ["practice", "appointment_id"]
+DB_INDEXES = ["appointment_date", "provider", "patient_guid"]
+
+# Patient GUID -> Kareo patientId, fed by every BootStrap response; fetched_at is the last time a mapping was seen
+PATIENT_INDEX_TABLE = "tebra_patient_index"
+PATIENT_INDEX_COLUMNS = [
+    ("patient_guid", "TEXT", lambda entry: entry[0]),
+    ("patient_id", "TEXT", lambda entry: str(entry[1])),
+]
+# Appointment GUID -> appointment mode, the other thing only BootStrap knows. Unlike a patient ID a mode
+# can change (in-office <-> telehealth), so entries older than REUSE_MAX_AGE_HOURS are fetched again
+MODE_INDEX_TABLE = "tebra_appointment_modes"
+MODE_INDEX_COLUMNS = [
+    ("appointment_guid", "TEXT", lambda entry: entry[0]),
+    ("appointment_mode", "TEXT", lambda entry: entry[1]),
+]
 
 def get_db_connection():
+    import psycopg2
+
     return psycopg2.connect(
         host=st.secrets["database"]["host"],
         port=st.secrets["database"]["port"],
@@ -21,22 +78,42 @@ def get_db_connection():
         password=st.secrets["database"]["password"]
     )
 
-# Fetch latest session from DB
-def get_latest_session():
+# Sessions are grouped by an optional practice_id column; rows without one belong to the "default" practice
+PRACTICE_SQL = "COALESCE(to_jsonb(s)->>'practice_id', 'default')"
+
+# Fetch latest session from DB, optionally for one practice; returns (practice, (cookie, csrf_token))
+def get_latest_session(practice=None):
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute("""
-        SELECT cookie, csrf_token 
-        FROM sessions
+    cur.execute(f"""
+        SELECT {PRACTICE_SQL}, cookie, csrf_token
+        FROM sessions s
         WHERE expires_at > NOW()
         AND source = 'tebra'
+        AND (%(practice)s IS NULL OR {PRACTICE_SQL} = %(practice)s)
         ORDER BY expires_at DESC
         LIMIT 1;
-    """)
+    """, {"practice": practice})
     row = cur.fetchone()
     cur.close()
     conn.close()
-    return row if row else None
+    return (row[0], row[1:]) if row else None
+
+# Newest valid session for every practice, for fleet runs
+def list_practice_sessions():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute(f"""
+        SELECT DISTINCT ON ({PRACTICE_SQL}) {PRACTICE_SQL}, cookie, csrf_token
+        FROM sessions s
+        WHERE expires_at > NOW()
+        AND source = 'tebra'
+        ORDER BY {PRACTICE_SQL}, expires_at DESC;
+    """)
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return {practice: (cookie, csrf_token) for practice, cookie, csrf_token in rows}
 
 # Convert date to milliseconds timestamp
 def date_to_ms_timestamp(input_date):
@@ -44,6 +121,524 @@ def date_to_ms_timestamp(input_date):
     timestamp = int((input_date - epoch).total_seconds() * 1000)
     return timestamp
 
+# Command-line options, e.g. streamlit run tebra.py -- --provider <guid> --status Scheduled --debug
+def parse_cli_options(argv):
+    parser = argparse.ArgumentParser(prog="tebra.py")
+    parser.add_argument("--provider", action="append", default=[], help="Provider GUID (repeatable)")
+    parser.add_argument("--location", action="append", default=[], help="Service location GUID (repeatable)")
+    parser.add_argument("--status", action="append", default=[], help="Appointment status (repeatable)")
+    parser.add_argument("--reason", action="append", default=[], help="Appointment reason GUID (repeatable)")
+    parser.add_argument("--debug", action="store_true", help="Show the diagnostics report")
+    args, _ = parser.parse_known_args(argv)
+    filters = {
+        "providers": args.provider,
+        "locations": args.location,
+        "statuses": args.status,
+        "reasons": args.reason,
+    }
+    return filters, args.debug
+
+# Filter options (GUID -> display name) seen in the fetched appointments
+def build_filter_catalog(appointment_list):
+    catalog = {"providers": {}, "locations": {}, "statuses": {}, "reasons": {}}
+    for appt in appointment_list:
+        if appt.get("providerGuid"):
+            catalog["providers"][appt["providerGuid"]] = appt.get("providerFullName") or appt["providerGuid"]
+        if appt.get("serviceLocationGuid"):
+            catalog["locations"][appt["serviceLocationGuid"]] = appt.get("serviceLocationName") or appt["serviceLocationGuid"]
+        if appt.get("appointmentStatus"):
+            catalog["statuses"][appt["appointmentStatus"]] = appt["appointmentStatus"]
+        if appt.get("appointmentReasonGuid"):
+            catalog["reasons"][appt["appointmentReasonGuid"]] = appt.get("appointmentReasonName") or appt["appointmentReasonGuid"]
+    return catalog
+
+# Headers for API requests; Kareo only needs the session cookie
+def build_headers(cookie_string, csrf_token=None):
+    return {
+        "accept": "*/*",
+        "accept-language": "en-GB,en-US;q=0.9,en;q=0.8",
+        "cache-control": "no-cache",
+        "content-type": "application/json",
+        "origin": "https://app.kareo.com",
+        "pragma": "no-cache",
+        "priority": "u=1, i",
+        "referer": "https://app.kareo.com/v2/",
+        "sec-ch-ua": '"Not;A=Brand";v="99", "Google Chrome";v="139", "Chromium";v="139"',
+        "sec-ch-ua-mobile": "?0",
+        "sec-ch-ua-platform": '"macOS"',
+        "sec-fetch-dest": "empty",
+        "sec-fetch-mode": "cors",
+        "sec-fetch-site": "same-origin",
+        "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/139.0.0.0 Safari/537.36",
+        "cookie": cookie_string
+    }
+
+def appointment_key(appt):
+    return str(appt.get("pmAppointmentId") or appt.get("appointmentGuid"))
+
+def patient_key(appt):
+    return appt.get("patientGuid")
+
+# Fetch appointments for the date range
+def fetch_appointments(client, start_timestamp, end_timestamp, filters):
+    # Prepare payload for appointments API; filters are applied server-side so only the matching set is returned
+    payload = {
+        "orderByList": [],
+        "pageSize": 50000,
+        "currentPage": 0,
+        "pmAppointmentId": None,
+        "startDate": start_timestamp,
+        "endDate": end_timestamp,
+        "patientGuid": None,
+        "providerGuids": filters["providers"] or None,
+        "serviceLocationGuids": filters["locations"],
+        "appointmentReasonGuids": filters["reasons"],
+        "ehrAppointmentStatuses": filters["statuses"] or None,
+        "groupAppointment": None,
+        "matchedCharge": None,
+        "linkedCharge": None,
+        "primaryInsurancePlanGuids": [],
+        "secondaryInsurancePlanGuids": [],
+        "pmPayerScenarioIds": [],
+        "patientHomePhone": None,
+        "patientMobilePhone": None,
+        "copayList": None,
+        "practiceTimezone": "America/New_York"
+    }
+
+    return client.post(
+        f"{BASE_URL}/worklist-ui/api/appointments/base",
+        json=payload
+    )
+
+# ---------- BOOTSTRAP PARSING ----------
+# Where the fields we need live in a BootStrap response. The response is either a
+# single section {"body": {"results": [...]}} or a list of such sections, each with
+# its own "status". Paths are compiled into getters once, at import time.
+BOOTSTRAP_SCHEMA = {
+    "results": ("body", "results"),
+    "appointment_uuid": ("appointmentUUID",),
+    "appointment_mode": ("appointmentMode",),
+    "patient_summary": ("patientSummary",),
+    "patient_guid": ("patientSummary", "guid"),
+    "patient_id": ("patientSummary", "patientId"),
+}
+
+def compile_path(path):
+    def get(obj):
+        for key in path:
+            if not isinstance(obj, dict):
+                return None
+            obj = obj.get(key)
+        return obj
+    return get
+
+BOOTSTRAP_FIELDS = {name: compile_path(path) for name, path in BOOTSTRAP_SCHEMA.items()}
+
+# Single pass over either response shape; returns (patient_id_map, appointment_mode_map, report)
+def parse_bootstrap(bootstrap_data):
+    get = BOOTSTRAP_FIELDS
+    patient_id_map = {}
+    appointment_mode_map = {}
+    report = {
+        "response_type": type(bootstrap_data).__name__,
+        "sections": [],
+        "appointments": 0,
+        "skipped_items": 0,
+    }
+
+    if isinstance(bootstrap_data, dict):
+        report["keys"] = list(bootstrap_data.keys())
+        sections = [bootstrap_data]
+    elif isinstance(bootstrap_data, list):
+        sections = bootstrap_data
+    else:
+        sections = []
+
+    for section in sections:
+        if not isinstance(section, dict):
+            report["skipped_items"] += 1
+            continue
+
+        # A single-section response has no status of its own; list items without one are treated as failed
+        status = section.get("status", 200 if isinstance(bootstrap_data, dict) else None)
+        results = get["results"](section)
+        report["sections"].append({
+            "status": status,
+            "results": len(results) if isinstance(results, list) else type(results).__name__,
+        })
+        if status != 200 or not isinstance(results, list):
+            continue
+
+        for bootstrap_appt in results:
+            if not isinstance(bootstrap_appt, dict):
+                report["skipped_items"] += 1
+                continue
+            report["appointments"] += 1
+
+            # Keep one example of the structure for the debug report
+            if "example_keys" not in report:
+                report["example_keys"] = list(bootstrap_appt.keys())
+                patient_summary = get["patient_summary"](bootstrap_appt)
+                report["patient_summary_keys"] = list(patient_summary.keys()) if isinstance(patient_summary, dict) else None
+
+            appt_uuid = get["appointment_uuid"](bootstrap_appt)
+            if appt_uuid:
+                appointment_mode_map[appt_uuid] = get["appointment_mode"](bootstrap_appt) or "N/A"
+
+            patient_guid = get["patient_guid"](bootstrap_appt)
+            patient_id = get["patient_id"](bootstrap_appt)
+            if patient_guid and patient_id not in (None, "", "N/A"):
+                patient_id_map[patient_guid] = patient_id
+
+    report["patients_mapped"] = len(patient_id_map)
+    report["modes_mapped"] = len(appointment_mode_map)
+    return patient_id_map, appointment_mode_map, report
+
+# Fetch appointment modes and patient IDs from the Bootstrap API
+def fetch_bootstrap_maps(client, start_timestamp, end_timestamp, appointment_list, log):
+    # Prepare payload for Bootstrap API - convert timestamps to strings
+    bootstrap_payload = [
+        {
+            "resource": "ApptWithMode",
+            "query": {
+                "minDate": str(start_timestamp),
+                "maxDate": str(end_timestamp),
+                "deleted": False,
+                "maxDaysPerPage": 5
+            }
+        }
+    ]
+
+    # Make the API call to Bootstrap using PUT method
+    bootstrap_resp = client.put(
+        f"{BASE_URL}/dashboard-calendar-ui/api/BootStrap/",
+        json=bootstrap_payload
+    )
+
+    patient_id_map = {}
+    appointment_mode_map = {}
+    report = {}
+    if bootstrap_resp.status_code == 200:
+        try:
+            patient_id_map, appointment_mode_map, report = parse_bootstrap(bootstrap_resp.json())
+        except ValueError as e:
+            log(f"Error parsing Bootstrap API response: {str(e)}", "error")
+            report["response_preview"] = bootstrap_resp.text[:500]
+    else:
+        log(f"Bootstrap API call failed with status {bootstrap_resp.status_code}", "error")
+        report["response_preview"] = bootstrap_resp.text[:500]
+
+        # Fallback: use patient IDs the main API response states explicitly.
+        # IDs are never guessed from other fields or the GUID, since a wrong ID
+        # only produces BillingProfile requests for the wrong (or no) patient.
+        for appt in appointment_list:
+            patient_guid = appt.get("patientGuid")
+            if not patient_guid:
+                continue
+
+            # Some APIs include patient ID directly in the main response
+            if appt.get("patientId"):
+                patient_id_map[patient_guid] = appt.get("patientId")
+            # Or it might be embedded in the patient object
+            elif isinstance(appt.get("patient"), dict) and appt["patient"].get("id"):
+                patient_id_map[patient_guid] = appt["patient"].get("id")
+        report["fallback_patients_mapped"] = len(patient_id_map)
+
+    report["status_code"] = bootstrap_resp.status_code
+    return patient_id_map, appointment_mode_map, report
+
+# Look up known values for these keys in a persistent index (patient IDs or appointment modes)
+# `max_age_hours` skips values not seen recently, for mappings that can change
+def load_index(table, columns, keys, max_age_hours=None):
+    (key_column, _, _), (value_column, _, _) = columns
+    conn = get_db_connection()
+    try:
+        # Only issues DDL the first time this process touches the table
+        ensure_table(conn, table, columns, key_column, [])
+        with conn.cursor() as cur:
+            cur.execute(
+                f"SELECT {key_column}, {value_column} FROM {SCHEMA}.{table} WHERE {key_column} = ANY(%s)"
+                " AND (%s IS NULL OR fetched_at >= NOW() - %s * INTERVAL '1 hour')",
+                (list(keys), max_age_hours, max_age_hours)
+            )
+            return dict(cur.fetchall())
+    finally:
+        conn.close()
+
+# Record key -> value mappings seen in this run
+def save_index(table, columns, mapping):
+    conn = get_db_connection()
+    try:
+        return persist_rows(conn, table, columns, columns[0][0], list(mapping.items()))
+    finally:
+        conn.close()
+
+# Fetch billing profile (insurance details) for one patient ID
+# Returns (insurance data, error message) so worker threads never write to the page
+def fetch_insurance_details(client, patient_id):
+    insurance_data = None
+    error = None
+    try:
+        # Make API call to get insurance details
+        insurance_resp = client.get(
+            f"{BASE_URL}/billing-profiles-ui/api/BillingProfile/patient/{patient_id}"
+        )
+
+        if insurance_resp.status_code == 200:
+            # Parse the insurance data
+            insurance_data = insurance_resp.json()
+        else:
+            error = f"⚠️ Failed to fetch insurance details for patient ID {patient_id}: {insurance_resp.status_code}"
+    except SessionExpired:
+        raise
+    except Exception as e:
+        error = f"❌ Error fetching insurance details for patient ID {patient_id}: {str(e)}"
+
+    # Add a small delay to avoid rate limiting
+    time.sleep(0.1)
+    return insurance_data, error
+
+# Clean up the alert message - replace all newlines and multiple spaces with a single space
+def clean_alert_message(alert_message):
+    return ' '.join(alert_message.replace('\n', ' ').split())
+
+# Fetch the alert message for one patient GUID
+def fetch_patient_alert(client, patient_guid):
+    alert_message = "N/A"
+    try:
+        # Make API call to get patient alerts
+        alert_url = f"{BASE_URL}/billing-profiles-ui/api/PatientAlert/{patient_guid}/alert"
+
+        alert_resp = client.get(alert_url)
+
+        if alert_resp.status_code == 200:
+            # Parse the alert data
+            alert_data = alert_resp.json()
+
+            # Extract the alert message
+            if isinstance(alert_data, dict) and "alertMessage" in alert_data:
+                alert_message = clean_alert_message(alert_data["alertMessage"])
+            else:
+                # Try second URL format (plural "alerts")
+                alert_url2 = f"{BASE_URL}/billing-profiles-ui/api/PatientAlert/{patient_guid}/alerts"
+
+                alert_resp2 = client.get(alert_url2)
+
+                if alert_resp2.status_code == 200:
+                    alert_data2 = alert_resp2.json()
+
+                    # Check if it's a list of alerts; take the first alert message
+                    if isinstance(alert_data2, list) and alert_data2:
+                        if isinstance(alert_data2[0], dict) and "alertMessage" in alert_data2[0]:
+                            alert_message = clean_alert_message(alert_data2[0]["alertMessage"])
+    except SessionExpired:
+        raise
+    except Exception as e:
+        alert_message = "N/A"
+
+    # Add a small delay to avoid rate limiting
+    time.sleep(0.1)
+    return alert_message
+
+# Insurance and alert calls for one patient
+def fetch_patient_details(client, patient_guid, patient_id):
+    insurance_details = None
+    error = None
+    if patient_id != "N/A" and isinstance(patient_id, (int, str)):
+        insurance_details, error = fetch_insurance_details(client, str(patient_id))
+    alert_message = fetch_patient_alert(client, patient_guid) if patient_guid else "N/A"
+    return {"insurance": insurance_details, "alert": alert_message, "error": error}
+
+# Build one record for an appointment
+def build_record(appt, patient_id, appointment_mode, details, practice=None):
+    # Patient name - combine first, middle, last
+    first_name = appt.get("patientFirstName", "")
+    middle_name = appt.get("patientMiddleName", "")
+    last_name = appt.get("patientLastName", "")
+    patient_name = f"{first_name} {middle_name} {last_name}".strip()
+    patient_name = patient_name if patient_name else appt.get("patientFullName", "N/A")
+
+    # Extract patient details if available
+    phone = appt.get("patientMobilePhone") or appt.get("patientHomePhone", "N/A")
+
+    # Extract basic insurance info from appointment data
+    basic_primary_insurance = appt.get("primaryInsurancePlanName", "N/A")
+    basic_primary_policy = appt.get("primaryInsurancePolicyNumber", "N/A")
+    basic_secondary_insurance = appt.get("secondaryInsurancePlanName", "N/A")
+    basic_secondary_policy = appt.get("secondaryInsurancePolicyNumber", "N/A")
+
+    # Extract detailed insurance info if available
+    primary_insurance = basic_primary_insurance
+    primary_policy = basic_primary_policy
+
+    secondary_insurance = basic_secondary_insurance
+    secondary_policy = basic_secondary_policy
+
+    # Get detailed insurance information from the billing profiles API
+    insurance_details = details["insurance"]
+    if insurance_details:
+        # Extract patient case information (insurance details)
+        if "patientCases" in insurance_details and insurance_details["patientCases"]:
+            # Get the first patient case (usually the active one)
+            patient_case = insurance_details["patientCases"][0]
+
+            # Check if policies exist
+            if "policies" in patient_case:
+                policies = patient_case["policies"]
+
+                # Primary insurance (key "1")
+                if "1" in policies:
+                    primary_policy_info = policies["1"]
+                    primary_insurance = primary_policy_info.get("planName", basic_primary_insurance)
+
+                # Secondary insurance (key "2")
+                if "2" in policies:
+                    secondary_policy_info = policies["2"]
+                    secondary_insurance = secondary_policy_info.get("planName", basic_secondary_insurance)
+
+    return AppointmentRecord(
+        platform=PLATFORM,
+        appointment_id=appointment_key(appt),
+        patient_id=patient_id,
+        patient_key=appt.get("patientGuid"),
+        patient_name=patient_name,
+        dob=parse_date(appt.get("patientDoB")),
+        provider=appt.get("providerFullName", "N/A"),
+        start_time=parse_start_time(appt.get("appointmentStart")),
+        appointment_type=appt.get("appointmentReasonName", "N/A"),
+        appointment_mode=appointment_mode,
+        status=appt.get("appointmentStatus", "N/A"),
+        primary=InsurancePolicy(primary_insurance, primary_policy),
+        secondary=InsurancePolicy(secondary_insurance, secondary_policy),
+        alert_message=details["alert"],
+        phone=phone,
+        practice=practice,
+    )
+
+# Full fetch and enrichment for one date range; runs on a background job thread, so no st.* calls here
+# `practice`/`session` are set by fleet runs; otherwise the newest session, and its practice, are used
+def run_sync(job, start_date, end_date, filters, incremental, save_to_db, debug=False, practice=None, session=None):
+    practice, client = open_client(
+        job, get_latest_session, build_headers, practice, session, pool_size=MAX_WORKERS, rate_limit=RATE_LIMIT
+    )
+
+    # Calculate start and end timestamps for the selected date range
+    start_datetime = datetime.combine(start_date, datetime.min.time())
+    end_datetime = datetime.combine(end_date, datetime.max.time())
+
+    start_timestamp = date_to_ms_timestamp(start_datetime)
+    end_timestamp = date_to_ms_timestamp(end_datetime)
+
+    # Fetch appointments
+    resp = fetch_appointments(client, start_timestamp, end_timestamp, filters)
+    if resp.status_code != 200:
+        raise RuntimeError(f"Failed to fetch appointments: {resp.text}")
+
+    appointments = resp.json()
+
+    # Check if we have a valid response with appointments
+    if not appointments or "data" not in appointments:
+        raise RuntimeError("No appointments found or invalid response format.")
+
+    appointment_list = appointments.get("data", [])
+    job.log(f"✅ Fetched {len(appointment_list)} appointments")
+    job.set_total(len(appointment_list))
+    # Each practice keeps its own snapshot and filter catalog
+    save_catalog(f"{PLATFORM}.{practice}", build_filter_catalog(appointment_list))
+    sync = IncrementalSync(job, f"{PLATFORM}.{practice}", appointment_list, appointment_key, patient_key, incremental, practice)
+    changed_appointments = [appt for appts in sync.pending.values() for appt in appts]
+
+    patient_id_map = {}
+    appointment_mode_map = {}
+    bootstrap_report = {}
+    if changed_appointments:
+        # Resolve patient IDs and appointment modes from the persistent indexes first
+        changed_guids = {appt.get("patientGuid") for appt in changed_appointments if appt.get("patientGuid")}
+        changed_appointment_guids = {
+            appt.get("appointmentGuid") for appt in changed_appointments if appt.get("appointmentGuid")
+        }
+        try:
+            patient_id_map = load_index(PATIENT_INDEX_TABLE, PATIENT_INDEX_COLUMNS, changed_guids)
+            appointment_mode_map = load_index(
+                MODE_INDEX_TABLE, MODE_INDEX_COLUMNS, changed_appointment_guids, REUSE_MAX_AGE_HOURS
+            )
+            job.log(
+                f"Resolved {len(patient_id_map)} of {len(changed_guids)} patient IDs and "
+                f"{len(appointment_mode_map)} of {len(changed_appointment_guids)} appointment modes from the index"
+            )
+        except Exception as e:
+            job.log(f"Patient index unavailable, resolving IDs from Bootstrap only: {str(e)}", "warning")
+        unresolved_appointments = [
+            appt for appt in changed_appointments if appt.get("patientGuid") not in patient_id_map
+        ]
+        missing_modes = changed_appointment_guids - set(appointment_mode_map)
+
+        # BootStrap is a single date-range call; it's only needed while something is still unknown
+        if unresolved_appointments or missing_modes:
+            job.log("Fetching additional appointment details...")
+            bootstrap_id_map, bootstrap_mode_map, bootstrap_report = fetch_bootstrap_maps(
+                client, start_timestamp, end_timestamp, unresolved_appointments, job.log
+            )
+
+            # Feed everything Bootstrap returned back into the indexes
+            bootstrap_id_map = {
+                guid: str(patient_id) for guid, patient_id in bootstrap_id_map.items()
+                if patient_id not in (None, "", "N/A")
+            }
+            bootstrap_mode_map = {guid: mode for guid, mode in bootstrap_mode_map.items() if mode != "N/A"}
+            try:
+                if bootstrap_id_map:
+                    save_index(PATIENT_INDEX_TABLE, PATIENT_INDEX_COLUMNS, bootstrap_id_map)
+                if bootstrap_mode_map:
+                    save_index(MODE_INDEX_TABLE, MODE_INDEX_COLUMNS, bootstrap_mode_map)
+            except Exception as e:
+                job.log(f"Failed to update the patient index: {str(e)}", "warning")
+            patient_id_map.update(bootstrap_id_map)
+            appointment_mode_map.update(bootstrap_mode_map)
+        else:
+            job.log("Every patient ID and appointment mode came from the index; skipping Bootstrap")
+
+        job.log(f"Mapped {len(patient_id_map)} patient GUIDs and {len(appointment_mode_map)} appointment modes")
+
+        # Fetch insurance details and alerts for each new or changed patient
+        job.log("Fetching insurance details and alerts for patients...")
+
+    unmapped_guids = {guid for guid in sync.pending if guid and guid not in patient_id_map}
+    if unmapped_guids:
+        job.log(f"{len(unmapped_guids)} patients have no patient ID; their insurance details are skipped", "warning")
+
+    # Diagnostics are collected into one report and only shown in debug mode
+    if debug and changed_appointments:
+        bootstrap_report["unmapped_patient_guids"] = sorted(unmapped_guids)
+        job.log({"bootstrap": bootstrap_report}, "report")
+
+    def fetch_details(patient_guid):
+        details = fetch_patient_details(client, patient_guid, patient_id_map.get(patient_guid, "N/A"))
+        if details["error"]:
+            job.log(details["error"])
+        return details
+
+    # Patient ID and appointment mode come from the mappings
+    def build(appt, details):
+        patient_id = patient_id_map.get(appt.get("patientGuid"), "N/A")
+        appointment_mode = appointment_mode_map.get(appt.get("appointmentGuid"), "N/A")
+        return build_record(appt, patient_id, appointment_mode, details, practice)
+
+    details_by_patient = sync.enrich(job, fetch_details, build, MAX_WORKERS)
+
+    insurance_count = sum(1 for details in details_by_patient.values() if details["insurance"])
+    alert_count = sum(1 for details in details_by_patient.values() if details["alert"] != "N/A")
+    job.log(f"Fetched insurance details for {insurance_count} patients")
+    job.log(f"Fetched alerts for {len(details_by_patient)} patients, found {alert_count} with alert messages")
+    data = sync.finish()
+
+    # Persist to Postgres
+    if save_to_db and data:
+        save_records(job, get_db_connection, DB_TABLE, DB_COLUMNS, DB_KEY, data, DB_INDEXES)
+
+    return AppointmentBatch.from_records(data)
+
 # ---------- STREAMLIT UI ----------
 st.title("Tebra Patient Dashboard")
 st.write("Fetch appointments and patient details from Kareo/Tebra")
@@ -55,544 +650,80 @@ start_date, end_date = st.date_input(
     format="YYYY-MM-DD"
 )
 
-if st.button("Fetch Appointments"):
-    st.write("Fetching data...")
-    with st.status("Fetching data...", expanded=True) as status:
-        session = get_latest_session()
-        if not session:
-            st.error("⚠️ No valid session found in DB")
-        else:
-            # Extract cookie string from session tuple
-            cookie_string = session[0]  # First element of the tuple
-            st.write("✅ Got session from DB")
-
-            # Calculate start and end timestamps for the selected date range
-            start_datetime = datetime.combine(start_date, datetime.min.time())
-            end_datetime = datetime.combine(end_date, datetime.max.time())
-            
-            start_timestamp = date_to_ms_timestamp(start_datetime)
-            end_timestamp = date_to_ms_timestamp(end_datetime)
-
-            # Headers for API request
-            HEADERS = {
-                "accept": "*/*",
-                "accept-language": "en-GB,en-US;q=0.9,en;q=0.8",
-                "cache-control": "no-cache",
-                "content-type": "application/json",
-                "origin": "https://app.kareo.com",
-                "pragma": "no-cache",
-                "priority": "u=1, i",
-                "referer": "https://app.kareo.com/v2/",
-                "sec-ch-ua": '"Not;A=Brand";v="99", "Google Chrome";v="139", "Chromium";v="139"',
-                "sec-ch-ua-mobile": "?0",
-                "sec-ch-ua-platform": '"macOS"',
-                "sec-fetch-dest": "empty",
-                "sec-fetch-mode": "cors",
-                "sec-fetch-site": "same-origin",
-                "user-agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/139.0.0.0 Safari/537.36",
-                "cookie": cookie_string
-            }
-        
-        # Prepare payload for appointments API
-        payload = {
-            "orderByList": [],
-            "pageSize": 50000,
-            "currentPage": 0,
-            "pmAppointmentId": None,
-            "startDate": start_timestamp,
-            "endDate": end_timestamp,
-            "patientGuid": None,
-            "providerGuids": None,
-            "serviceLocationGuids": [],
-            "appointmentReasonGuids": [],
-            "ehrAppointmentStatuses": None,
-            "groupAppointment": None,
-            "matchedCharge": None,
-            "linkedCharge": None,
-            "primaryInsurancePlanGuids": [],
-            "secondaryInsurancePlanGuids": [],
-            "pmPayerScenarioIds": [],
-            "patientHomePhone": None,
-            "patientMobilePhone": None,
-            "copayList": None,
-            "practiceTimezone": "America/New_York"
-        }
+cli_filters, cli_debug = parse_cli_options(sys.argv[1:])
+incremental, progressive, save_to_db, fleet = sync_options(DB_TABLE)
+
+debug = st.checkbox(
+    "Debug output",
+    value=cli_debug,
+    help="Show a structured diagnostics report (Bootstrap response shape, unmapped patients) with the results."
+)
+
+# Practices the next fetch covers, so the filters offer only their options; cached like the session identity
+@st.cache_data(ttl=SESSION_IDENTITY_TTL, show_spinner=False)
+def catalog_practices(fleet):
+    try:
+        if fleet:
+            return sorted(list_practice_sessions())
+        latest = get_latest_session()
+        return [latest[0]] if latest else []
+    except Exception:
+        # GUIDs from the command line still work while the DB can't be reached
+        return []
+
+# Filters are sent to the appointments API, so only the matching appointments are fetched and enriched
+catalog = {}
+for practice in catalog_practices(fleet):
+    for group, values in load_catalog(f"{PLATFORM}.{practice}").items():
+        catalog.setdefault(group, {}).update(values)
+
+def filter_select(label, group):
+    names = catalog.get(group, {})
+    options = list(names) + [value for value in cli_filters[group] if value not in names]
+    return st.multiselect(
+        label,
+        options=options,
+        default=cli_filters[group],
+        format_func=lambda value: names.get(value, value),
+    )
+
+with st.expander("Filters", expanded=any(cli_filters.values())):
+    filters = {
+        "providers": filter_select("Providers", "providers"),
+        "locations": filter_select("Service locations", "locations"),
+        "statuses": filter_select("Appointment statuses", "statuses"),
+        "reasons": filter_select("Appointment reasons", "reasons"),
+    }
+    if not catalog:
+        st.caption("Filter options are filled in after the first fetch. GUIDs can also be passed on the command line: "
+                   "`streamlit run tebra.py -- --provider <guid> --location <guid> --status <status> --reason <guid>`")
+
+# Fetches run in the background; identical requests share one job, and its results are cached for a while
+job = fetch_job(
+    PLATFORM, "Fetch Appointments",
+    (
+        str(start_date), str(end_date), tuple((group, tuple(sorted(values))) for group, values in filters.items()),
+        incremental, save_to_db, debug,
+    ),
+    run_sync, (start_date, end_date, filters, incremental, save_to_db, debug),
+    get_latest_session, list_practice_sessions, fleet, progressive, RESULT_COLUMNS,
+)
+if job:
+    data = job.result
 
-        # Fetch appointments
-        resp = requests.post(
-            f"{BASE_URL}/worklist-ui/api/appointments/base",
-            headers=HEADERS,
-            json=payload
+    # Page through the results; the full extract stays server-side
+    if data:
+        table = results_table(job.id, data, RESULT_COLUMNS)
+        paged_table(table, "results")
+
+        # Option to download as CSV
+        st.download_button(
+            label="Download data as CSV",
+            data=results_csv(job.id, table),
+            file_name=f"tebra_appointments_{start_date}_to_{end_date}.csv",
+            mime="text/csv",
         )
+    else:
+        st.warning("No appointment data to display.")
 
-        if resp.status_code != 200:
-            st.error(f"Failed to fetch appointments: {resp.text}")
-        else:
-            appointments = resp.json()
-            
-            # Check if we have a valid response with appointments
-            if not appointments or "data" not in appointments:
-                st.error("No appointments found or invalid response format.")
-            else:
-                appointment_list = appointments.get("data", [])
-                st.write(f"✅ Fetched {len(appointment_list)} appointments")
-
-                # Fetch additional appointment details from Bootstrap API
-                st.write("Fetching additional appointment details...")
-                
-                # Prepare payload for Bootstrap API - convert timestamps to strings
-                bootstrap_payload = [
-                    {
-                        "resource": "ApptWithMode",
-                        "query": {
-                            "minDate": str(start_timestamp),
-                            "maxDate": str(end_timestamp),
-                            "deleted": False,
-                            "maxDaysPerPage": 5
-                        }
-                    }
-                ]
-                
-                # Make the API call to Bootstrap using PUT method
-                st.write("Making Bootstrap API call using PUT method...")
-                bootstrap_resp = requests.put(
-                    f"{BASE_URL}/dashboard-calendar-ui/api/BootStrap/",
-                    headers=HEADERS,
-                    json=bootstrap_payload
-                )
-                
-                # Create a mapping of patient GUIDs to patient IDs
-                patient_id_map = {}
-                appointment_mode_map = {}
-                
-                # Debug information
-                # st.write(f"Bootstrap API response status: {bootstrap_resp.status_code}")
-                
-                if bootstrap_resp.status_code == 200:
-                    try:
-                        # Try to parse the JSON response
-                        bootstrap_data = bootstrap_resp.json()
-                        
-                        # Debug the response content first
-                        # st.write("Bootstrap API raw response content (first 500 chars):")
-                        response_text = bootstrap_resp.text
-                        # st.write(response_text[:500] + "..." if len(response_text) > 500 else response_text)
-                        
-                        # Debug the structure of the response
-                        st.write("Bootstrap API response structure:")
-                        
-                        # Check if bootstrap_data is a dictionary
-                        if isinstance(bootstrap_data, dict):
-                            st.write(f"Keys in response: {list(bootstrap_data.keys())}")
-                            
-                            if "body" in bootstrap_data:
-                                # Check if body is a dictionary
-                                if isinstance(bootstrap_data["body"], dict):
-                                    st.write(f"Keys in body: {list(bootstrap_data['body'].keys())}")
-                                    
-                                    if "results" in bootstrap_data["body"]:
-                                        bootstrap_appointments = bootstrap_data["body"]["results"]
-                                        
-                                        # Check if results is a list
-                                        if isinstance(bootstrap_appointments, list):
-                                            st.write(f"Number of appointments in Bootstrap response: {len(bootstrap_appointments)}")
-                                            
-                                            # Show the first appointment structure if available
-                                            if bootstrap_appointments:
-                                                st.write("Example appointment structure:")
-                                                if isinstance(bootstrap_appointments[0], dict):
-                                                    st.write(f"Keys in first appointment: {list(bootstrap_appointments[0].keys())}")
-                                                    
-                                                    # Check if patientSummary exists
-                                                    if "patientSummary" in bootstrap_appointments[0]:
-                                                        if isinstance(bootstrap_appointments[0]["patientSummary"], dict):
-                                                            st.write(f"Keys in patientSummary: {list(bootstrap_appointments[0]['patientSummary'].keys())}")
-                                                        else:
-                                                            st.write("patientSummary is not a dictionary")
-                                                else:
-                                                    st.write("First appointment is not a dictionary")
-                                            
-                                            for bootstrap_appt in bootstrap_appointments:
-                                                if not isinstance(bootstrap_appt, dict):
-                                                    continue
-                                                    
-                                                appt_uuid = bootstrap_appt.get("appointmentUUID")
-                                                appointment_mode = bootstrap_appt.get("appointmentMode", "N/A")
-                                                if appt_uuid:
-                                                    appointment_mode_map[appt_uuid] = appointment_mode
-                                                
-                                                # Extract patient info if available
-                                                patient_summary = bootstrap_appt.get("patientSummary")
-                                                if patient_summary and isinstance(patient_summary, dict):
-                                                    patient_guid = patient_summary.get("guid")
-                                                    patient_id = patient_summary.get("patientId", "N/A")
-                                                    if patient_guid:
-                                                        patient_id_map[patient_guid] = patient_id
-                                                        # st.write(f"Mapped patient GUID {patient_guid} to ID {patient_id}")
-                                        else:
-                                            st.write("Results is not a list")
-                                    else:
-                                        st.write("No 'results' found in the body")
-                                else:
-                                    st.write("Body is not a dictionary")
-                            else:
-                                st.write("No 'body' found in the response")
-                        elif isinstance(bootstrap_data, list):
-                            st.write("Response is a list with length:", len(bootstrap_data))
-                            if bootstrap_data:
-                                st.write("First item type:", type(bootstrap_data[0]).__name__)
-                                if isinstance(bootstrap_data[0], dict):
-                                    st.write(f"Keys in first item: {list(bootstrap_data[0].keys())}")
-                                    
-                                    # Process list-type response
-                                    for item in bootstrap_data:
-                                        if isinstance(item, dict) and "status" in item and item["status"] == 200:
-                                            if "body" in item and isinstance(item["body"], dict) and "results" in item["body"]:
-                                                bootstrap_appointments = item["body"]["results"]
-                                                
-                                                if isinstance(bootstrap_appointments, list):
-                                                    st.write(f"Found {len(bootstrap_appointments)} appointments in list response")
-                                                    
-                                                    # Process appointments
-                                                    for bootstrap_appt in bootstrap_appointments:
-                                                        if not isinstance(bootstrap_appt, dict):
-                                                            continue
-                                                            
-                                                        appt_uuid = bootstrap_appt.get("appointmentUUID")
-                                                        appointment_mode = bootstrap_appt.get("appointmentMode", "N/A")
-                                                        if appt_uuid:
-                                                            appointment_mode_map[appt_uuid] = appointment_mode
-                                                        
-                                                        # Extract patient info if available
-                                                        patient_summary = bootstrap_appt.get("patientSummary")
-                                                        if patient_summary and isinstance(patient_summary, dict):
-                                                            patient_guid = patient_summary.get("guid")
-                                                            patient_id = patient_summary.get("patientId", "N/A")
-                                                            if patient_guid and patient_id != "N/A":
-                                                                patient_id_map[patient_guid] = patient_id
-                                                                # st.write(f"Mapped patient GUID {patient_guid} to ID {patient_id}")
-                        else:
-                            st.write(f"Response is not a dictionary or list, type: {type(bootstrap_data).__name__}")
-                    except Exception as e:
-                        st.error(f"Error parsing Bootstrap API response: {str(e)}")
-                        st.write("Response content (first 500 chars):")
-                        response_text = bootstrap_resp.text
-                        st.write(response_text[:500] + "..." if len(response_text) > 500 else response_text)
-                else:
-                    st.error(f"Bootstrap API call failed with status {bootstrap_resp.status_code}")
-                    st.write(f"Error response: {bootstrap_resp.text}")
-                    
-                    # Fallback: Try to extract patient IDs from the main API response if available
-                    st.write("Attempting to extract patient IDs from main API response...")
-                    
-                    # Check if we can find patient IDs in the main response
-                    for appt in appointment_list:
-                        patient_guid = appt.get("patientGuid")
-                        
-                        # Some APIs include patient ID directly in the main response
-                        if "patientId" in appt:
-                            patient_id = appt.get("patientId")
-                            patient_id_map[patient_guid] = patient_id
-                            # st.write(f"Found patient ID in main response: {patient_guid} -> {patient_id}")
-                        # Or it might be embedded in a different field
-                        elif "patient" in appt and isinstance(appt.get("patient"), dict):
-                            patient_data = appt.get("patient")
-                            if "id" in patient_data:
-                                patient_id = patient_data.get("id")
-                                patient_id_map[patient_guid] = patient_id
-                                # st.write(f"Found patient ID in patient object: {patient_guid} -> {patient_id}")
-                        # Last resort: Try to extract from URLs or other fields
-                        else:
-                            # Try to find patient ID in any URL fields that might contain it
-                            for key, value in appt.items():
-                                if isinstance(value, str) and "patient" in key.lower() and value.isdigit():
-                                    patient_id = value
-                                    patient_id_map[patient_guid] = patient_id
-                                    # st.write(f"Found potential patient ID in field {key}: {patient_guid} -> {patient_id}")
-                            
-                            # If we still don't have an ID, try to generate one from the GUID
-                            if patient_guid and patient_guid not in patient_id_map:
-                                # Extract last part of GUID as a fallback ID
-                                if "-" in patient_guid:
-                                    last_part = patient_guid.split("-")[-1]
-                                    # Convert to a number if possible
-                                    try:
-                                        numeric_id = int(last_part, 16)  # Convert from hex
-                                        patient_id_map[patient_guid] = numeric_id
-                                        # st.write(f"Generated patient ID from GUID: {patient_guid} -> {numeric_id}")
-                                    except ValueError:
-                                        pass
-                
-                # Process appointments
-                data = []
-                
-                # Debug patient GUID mapping
-                st.write(f"Number of patient GUIDs mapped: {len(patient_id_map)}")
-                # st.write(f"Patient GUID map keys: {list(patient_id_map.keys())[:5] if len(patient_id_map) > 5 else list(patient_id_map.keys())}")
-                
-                # Debug appointment UUID mapping
-                st.write(f"Number of appointment UUIDs mapped: {len(appointment_mode_map)}")
-                # st.write(f"Appointment UUID map keys: {list(appointment_mode_map.keys())[:5] if len(appointment_mode_map) > 5 else list(appointment_mode_map.keys())}")
-                
-                # Fetch insurance details for each patient
-                st.write("Fetching insurance details for patients...")
-                
-                # Create dictionaries to store patient data
-                insurance_details_map = {}
-                patient_alerts_map = {}
-                
-                # Process only unique patient IDs to avoid duplicate API calls
-                unique_patient_ids = set()
-                for patient_guid, patient_id in patient_id_map.items():
-                    if patient_id != "N/A" and isinstance(patient_id, (int, str)):
-                        unique_patient_ids.add(str(patient_id))
-                
-                st.write(f"Found {len(unique_patient_ids)} unique patient IDs")
-                
-                # Fetch insurance details for each patient ID
-                for patient_id in unique_patient_ids:
-                    try:
-                        # Make API call to get insurance details
-                        insurance_resp = requests.get(
-                            f"{BASE_URL}/billing-profiles-ui/api/BillingProfile/patient/{patient_id}",
-                            headers=HEADERS
-                        )
-                        
-                        if insurance_resp.status_code == 200:
-                            # Parse the insurance data
-                            insurance_data = insurance_resp.json()
-                            
-                            # Store the insurance details
-                            insurance_details_map[patient_id] = insurance_data
-                            
-                            # Debug info
-                        else:
-                            st.write(f"⚠️ Failed to fetch insurance details for patient ID {patient_id}: {insurance_resp.status_code}")
-                    except Exception as e:
-                        st.write(f"❌ Error fetching insurance details for patient ID {patient_id}: {str(e)}")
-                    
-                    # Add a small delay to avoid rate limiting
-                    time.sleep(0.1)
-                
-                st.write(f"Fetched insurance details for {len(insurance_details_map)} patients")
-                
-                # Fetch patient alerts
-                st.write("Fetching patient alerts...")
-                
-                # Collect all unique patient GUIDs
-                unique_patient_guids = set()
-                for appt in appointment_list:
-                    patient_guid = appt.get("patientGuid")
-                    if patient_guid:
-                        unique_patient_guids.add(patient_guid)
-                
-                st.write(f"Found {len(unique_patient_guids)} unique patient GUIDs for alerts")
-                
-                # Track successful alerts
-                alert_count = 0
-                
-                # Fetch alerts for each patient GUID
-                for patient_guid in unique_patient_guids:
-                    try:
-                        # Make API call to get patient alerts
-                        alert_url = f"{BASE_URL}/billing-profiles-ui/api/PatientAlert/{patient_guid}/alert"
-                        
-                        alert_resp = requests.get(
-                            alert_url,
-                            headers=HEADERS
-                        )
-                        
-                        if alert_resp.status_code == 200:
-                            # Parse the alert data
-                            alert_data = alert_resp.json()
-                            
-                            # Extract the alert message
-                            if isinstance(alert_data, dict) and "alertMessage" in alert_data:
-                                # Clean up the alert message - replace multiple newlines with a single space
-                                alert_message = alert_data["alertMessage"]
-                                # Replace all newlines and multiple spaces with a single space
-                                alert_message = ' '.join(alert_message.replace('\n', ' ').split())
-                                patient_alerts_map[patient_guid] = alert_message
-                                alert_count += 1
-                            else:
-                                # Try second URL format (plural "alerts")
-                                alert_url2 = f"{BASE_URL}/billing-profiles-ui/api/PatientAlert/{patient_guid}/alerts"
-                                
-                                alert_resp2 = requests.get(
-                                    alert_url2,
-                                    headers=HEADERS
-                                )
-                                
-                                if alert_resp2.status_code == 200:
-                                    alert_data2 = alert_resp2.json()
-                                    
-                                    # Check if it's a list of alerts
-                                    if isinstance(alert_data2, list) and alert_data2:
-                                        # Take the first alert message
-                                        if isinstance(alert_data2[0], dict) and "alertMessage" in alert_data2[0]:
-                                            # Clean up the alert message - replace multiple newlines with a single space
-                                            alert_message = alert_data2[0]["alertMessage"]
-                                            # Replace all newlines and multiple spaces with a single space
-                                            alert_message = ' '.join(alert_message.replace('\n', ' ').split())
-                                            patient_alerts_map[patient_guid] = alert_message
-                                            alert_count += 1
-                                        else:
-                                            patient_alerts_map[patient_guid] = "N/A"
-                                    else:
-                                        patient_alerts_map[patient_guid] = "N/A"
-                                else:
-                                    patient_alerts_map[patient_guid] = "N/A"
-                        else:
-                            patient_alerts_map[patient_guid] = "N/A"
-                    except Exception as e:
-                        patient_alerts_map[patient_guid] = "N/A"
-                    
-                    # Add a small delay to avoid rate limiting
-                    time.sleep(0.1)
-                
-                st.write(f"Fetched alerts for {len(patient_alerts_map)} patients, found {alert_count} with alert messages")
-                
-                for appt in appointment_list:
-                    # Extract basic appointment info
-                    appt_id = appt.get("pmAppointmentId")
-                    patient_guid = appt.get("patientGuid")
-                    appt_uuid = appt.get("appointmentGuid")
-                    
-                    # Debug individual mapping
-                    if patient_guid and patient_guid not in patient_id_map:
-                        st.write(f"Patient GUID not found in map: {patient_guid}")
-                    
-                    # Get patient ID from mapping
-                    patient_id = patient_id_map.get(patient_guid, "N/A")
-                    
-                    # Get appointment mode from mapping
-                    appointment_mode = appointment_mode_map.get(appt_uuid, "N/A")
-                    
-                    # Patient name - combine first, middle, last
-                    first_name = appt.get("patientFirstName", "")
-                    middle_name = appt.get("patientMiddleName", "")
-                    last_name = appt.get("patientLastName", "")
-                    patient_name = f"{first_name} {middle_name} {last_name}".strip()
-                    patient_name = patient_name if patient_name else appt.get("patientFullName", "N/A")
-                    
-                    # Provider name
-                    provider_name = appt.get("providerFullName", "N/A")
-                    
-                    # Appointment details
-                    appointment_start = appt.get("appointmentStart")
-                    appointment_end = appt.get("appointmentEnd")
-                    status = appt.get("appointmentStatus", "N/A")
-                    appointment_type = appt.get("appointmentReasonName", "N/A")
-                    
-                    # Format timestamps to readable date/time
-                    if appointment_start:
-                        try:
-                            start_time = datetime.fromisoformat(appointment_start.replace('Z', '+00:00')).strftime('%Y-%m-%d %H:%M:%S')
-                        except:
-                            start_time = appointment_start
-                    else:
-                        start_time = "N/A"
-                        
-                    if appointment_end:
-                        try:
-                            end_time = datetime.fromisoformat(appointment_end.replace('Z', '+00:00')).strftime('%Y-%m-%d %H:%M:%S')
-                        except:
-                            end_time = appointment_end
-                    else:
-                        end_time = "N/A"
-                    
-                    # Extract patient details if available
-                    phone = appt.get("patientMobilePhone") or appt.get("patientHomePhone", "N/A")
-                    
-                    # Format DOB
-                    dob = appt.get("patientDoB", "N/A")
-                    if dob:
-                        try:
-                            dob = datetime.fromisoformat(dob.replace('Z', '+00:00')).strftime('%Y-%m-%d')
-                        except:
-                            dob = "N/A"
-                    
-                    # Extract basic insurance info from appointment data
-                    basic_primary_insurance = appt.get("primaryInsurancePlanName", "N/A")
-                    basic_primary_policy = appt.get("primaryInsurancePolicyNumber", "N/A")
-                    basic_secondary_insurance = appt.get("secondaryInsurancePlanName", "N/A")
-                    basic_secondary_policy = appt.get("secondaryInsurancePolicyNumber", "N/A")
-                    
-                    # Extract detailed insurance info if available
-                    primary_insurance = basic_primary_insurance
-                    primary_policy = basic_primary_policy
-                   
-                    
-                    secondary_insurance = basic_secondary_insurance
-                    secondary_policy = basic_secondary_policy
-               
-                    
-                    # Get detailed insurance information from the billing profiles API
-                    if patient_id != "N/A" and str(patient_id) in insurance_details_map:
-                        insurance_details = insurance_details_map[str(patient_id)]
-                        
-                        # Extract patient case information (insurance details)
-                        if "patientCases" in insurance_details and insurance_details["patientCases"]:
-                            # Get the first patient case (usually the active one)
-                            patient_case = insurance_details["patientCases"][0]
-                            
-                            # Check if policies exist
-                            if "policies" in patient_case:
-                                policies = patient_case["policies"]
-                                
-                                # Primary insurance (key "1")
-                                if "1" in policies:
-                                    primary_policy_info = policies["1"]
-                                    primary_insurance = primary_policy_info.get("planName", basic_primary_insurance)
-                                    
-                                    
-                                
-                                # Secondary insurance (key "2")
-                                if "2" in policies:
-                                    secondary_policy_info = policies["2"]
-                                    secondary_insurance = secondary_policy_info.get("planName", basic_secondary_insurance)
-                                    
-                                   
-                   
-                    # Get patient alert if available
-                    alert_message = patient_alerts_map.get(patient_guid, "N/A")
-                    
-                    # Add to data collection
-                    data.append({
-                        "Appointment ID": appt_id,
-                        "Patient ID": patient_id,
-                        "Patient GUID": patient_guid,
-                        "Patient Name": patient_name,
-                        "DOB": dob,
-                        "Provider": provider_name,
-                        "Start Time": start_time,
-                        "Appointment Type": appointment_type,
-                        "Appointment Mode": appointment_mode,
-                        "Primary Insurance": primary_insurance,
-                        "Primary Policy Number": primary_policy,
-                        "Secondary Insurance": secondary_insurance,
-                        "Secondary Policy Number": secondary_policy,
-                        "Alert Message": alert_message,
-                        "Phone": phone
-                    })
-                
-                # Create DataFrame and display
-                if data:
-                    df = pd.DataFrame(data)
-                    st.dataframe(df)
-                    
-                    # Option to download as CSV
-                    csv = df.to_csv(index=False)
-                    st.download_button(
-                        label="Download data as CSV",
-                        data=csv,
-                        file_name=f"tebra_appointments_{start_date}_to_{end_date}.csv",
-                        mime="text/csv",
-                    )
-                else:
-                    st.warning("No appointment data to display.")
-                
-                try:
-                    status.update(label="✅ All data fetched successfully!", state="complete")
-                except Exception as e:
-                    st.success("✅ All data fetched successfully!")
+render_timing("tebra", RUN_STARTED, IMPORTS_DONE)
@@ -0,0 +1,50 @@
+import pytest
+
+from ehr_context import (
+    CONTEXT_COLUMNS,
+    CONTEXT_TOKEN_BUDGET,
+    allocate_tokens,
+    build_row_context,
+    estimate_tokens,
+)
+
+
+def test_allocate_tokens_fills_short_fields_and_splits_the_rest():
+    assert allocate_tokens([5, 100, 100], 105) == [5, 50, 50]
+    assert allocate_tokens([5, 10], 100) == [5, 10]
+    assert sum(allocate_tokens([7, 300, 41, 999], 200)) <= 200
+
+
+@pytest.mark.parametrize("extra_columns", [0, 60, 100])
+def test_context_stays_within_budget_however_wide_the_sheet(extra_columns):
+    row = {column: "x" * 2000 for column in CONTEXT_COLUMNS}
+    row.update({f"Custom column {i}": "some value " * 20 for i in range(extra_columns)})
+
+    context, report = build_row_context(row)
+
+    assert estimate_tokens(context) <= CONTEXT_TOKEN_BUDGET
+    assert report["tokens"] <= CONTEXT_TOKEN_BUDGET
+    assert all(f"Custom column {i}" in report["dropped"] for i in range(extra_columns))
+    assert "Custom column" not in context
+
+
+def test_short_rows_are_sent_untouched():
+    row = {"Patient Name": "Jane Doe", "Primary Insurance": "Aetna", "EHR Note": "old note", "Auth": float("nan")}
+
+    context, report = build_row_context(row)
+
+    assert context == "Patient Name: Jane Doe\nPrimary Insurance: Aetna\n"
+    assert report == {"tokens": estimate_tokens("Patient Name: Jane Doe\n") + estimate_tokens("Primary Insurance: Aetna\n"),
+                      "dropped": [], "truncated": []}
+
+
+def test_small_budget_drops_lowest_ranked_fields_first():
+    row = {column: "y" * 400 for column in CONTEXT_COLUMNS}
+
+    context, report = build_row_context(row, budget=100)
+
+    assert estimate_tokens(context) <= 100
+    assert context.startswith("Appointment date: ")
+    assert report["dropped"][0] == CONTEXT_COLUMNS[-1]
+    assert set(report["truncated"]) == {line.split(":")[0] for line in context.splitlines()}
+    assert report["tokens"] == sum(estimate_tokens(line + "\n") for line in context.splitlines())